@@ -6,8 +6,25 @@ Support for Circus: process and socket manager.
 :platform:   all
 """
 
+import json
+import logging
+import uuid
+
 import salt.utils
 
+try:
+    import zmq
+    HAS_ZMQ = True
+except ImportError:
+    HAS_ZMQ = False
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ENDPOINT = 'tcp://127.0.0.1:5555'
+
+# One connected socket per circusd endpoint, kept for the life of the minion
+_SOCKETS = {}
+
 
 @salt.utils.memoize
 def __detect_os():
@@ -16,22 +33,101 @@ def __detect_os():
 
 def __virtual__():
     """
-    Only load the module if circus is installed.
+    Only load the module if circus is installed, or if pyzmq is available
+    and a circusd endpoint is configured to talk to it directly.
+    """
+    if __detect_os():
+        return 'circus'
+    if HAS_ZMQ and __opts__.get('circus.endpoint'):
+        return 'circus'
+    return False
+
+
+class CircusError(Exception):
+    """
+    Raised when circusd cannot be reached or refuses a command
+    """
+
+
+def _endpoint():
+    return __salt__['config.option']('circus.endpoint') or DEFAULT_ENDPOINT
+
+
+def _socket(endpoint):
+    """
+    Return the connected DEALER socket for endpoint, creating it on first use
     """
-    return 'circus' if __detect_os() else False
+    sock = _SOCKETS.get(endpoint)
+    if sock is None:
+        sock = zmq.Context.instance().socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(endpoint)
+        _SOCKETS[endpoint] = sock
+    return sock
+
+
+def _drop(endpoint):
+    sock = _SOCKETS.pop(endpoint, None)
+    if sock is not None:
+        sock.close()
+
+
+def _call(command, **properties):
+    """
+    Send a command to circusd over its JSON protocol and return the answer.
+    A socket which timed out is thrown away, so a late answer cannot be
+    taken for the answer to the next command.
+    """
+    endpoint = _endpoint()
+    timeout = float(__salt__['config.option']('circus.timeout') or 5)
+    message = {'id': uuid.uuid4().hex, 'command': command,
+               'properties': properties}
+    sock = _socket(endpoint)
+    try:
+        sock.send(json.dumps(message))
+        while True:
+            if not sock.poll(timeout * 1000):
+                raise CircusError('Timed out waiting for circusd at {0}'.format(endpoint))
+            answer = json.loads(sock.recv())
+            if answer.get('id') == message['id']:
+                break
+    except (zmq.ZMQError, ValueError, CircusError) as exc:
+        _drop(endpoint)
+        raise CircusError(str(exc))
+    # the status command answers with the watcher status instead of "ok"
+    if answer.get('status') == 'error':
+        raise CircusError(answer.get('reason', 'circusd refused {0}'.format(command)))
+    return answer
+
+
+def _native(command, key, **properties):
+    """
+    Run a command and return one field of the answer, or an error dict
+    """
+    try:
+        return _call(command, **properties)[key]
+    except CircusError as exc:
+        log.error('circus: {0} failed: {1}'.format(command, exc))
+        return {'Error': str(exc)}
 
 
 def version():
     """
-    Return circus version from circusctl --version
+    Return circus version from circusctl --version, circusd does not
+    report its version over the JSON protocol
 
     CLI Example::
 
         salt '*' circus.version
     """
-    cmd = '{0} --version'.format(__detect_os())
-    out = __salt__['cmd.run'](cmd)
-    return out.split(' ')[1]
+    circusctl = __detect_os()
+    if not circusctl:
+        return {'Error': 'circusctl is not installed'}
+    cmd = '{0} --version'.format(circusctl)
+    out = __salt__['cmd.run'](cmd).split()
+    if len(out) < 2:
+        return {'Error': 'Unexpected circusctl output: {0}'.format(' '.join(out))}
+    return out[1]
 
 
 def list(watcher=None):
@@ -46,6 +142,10 @@ def list(watcher=None):
 
 
 def _list(watcher):
+    if HAS_ZMQ:
+        if watcher:
+            return _native('list', 'pids', name=watcher)
+        return _native('list', 'watchers')
     arguments = '{0}'.format(watcher) if watcher else ''
     cmd = '{0} list {1}'.format(__detect_os(), arguments)
     return __salt__['cmd.run'](cmd).split(',')
@@ -59,18 +159,28 @@ def dstats():
 
         salt '*' circus.dstats
     """
+    if HAS_ZMQ:
+        return _native('dstats', 'info')
     cmd = '{0} dstats'.format(__detect_os())
     return __salt__['cmd.run'](cmd)
 
 
 def stats(watcher=None, pid=None):
     """
-    Return statistics of processes.
+    Return statistics of processes. Without a watcher, the statistics of
+    every process of every watcher, keyed by watcher and pid.
 
     CLI Example::
 
         salt '*' circus.stats mywatcher
     """
+    if HAS_ZMQ:
+        if watcher and pid:
+            return _native('stats', 'info', name=watcher, process=int(pid))
+        if watcher:
+            return _native('stats', 'info', name=watcher)
+        return _native('stats', 'infos')
+
     if watcher and pid:
         arguments = '{0} {1}'.format(watcher, pid)
     elif watcher and not pid:
@@ -85,15 +195,16 @@ def stats(watcher=None, pid=None):
     if pid:
         return out
 
-    processes = _list(None)
+    # watcher headers are the lines which are not indented
+    processes = set(_list(None))
     processes_dict = {}
     current_process = None
     for line in out:
-        for process in processes:
-            if process in line:
-                processes_dict[process] = []
-                current_process = process
-        if current_process not in line:
+        name = line.strip().rstrip(':')
+        if not line[:1].isspace() and name in processes:
+            processes_dict[name] = []
+            current_process = name
+        elif current_process is not None:
             processes_dict[current_process].append(line)
     return processes_dict
 
@@ -106,6 +217,12 @@ def status(watcher=None):
 
         salt '*' circus.status mywatcher
     """
+    if HAS_ZMQ:
+        if watcher:
+            ret = _native('status', 'status', name=watcher)
+            return ret if isinstance(ret, dict) else {watcher: ret}
+        return _native('status', 'statuses')
+
     if watcher:
         arguments = ' status {0}'.format(watcher)
     else:
@@ -129,6 +246,10 @@ def signal(signal, opts=None):
     if signal not in valid_signals:
         return
 
+    if HAS_ZMQ:
+        properties = {'name': opts} if opts else {}
+        return _native(signal, 'status', **properties)
+
     if opts:
         arguments = ' {0} {1}'.format(signal, opts)
     else:
@@ -15,10 +15,19 @@ Example::
 
 Configuration file can also be included such as::
     drizzle.default_file: '/etc/drizzle/config.cnf'
+
+Connections are pooled per DSN for the lifetime of a job. Idle pooled
+connections are pinged before reuse and closed once they have been idle
+for longer than ``drizzle.pool_max_idle`` seconds (300 by default)::
+    drizzle.pool_max_idle: 300
+    drizzle.pool_size: 4
 '''
 
 # Importing the required libraries
-import re
+import csv
+import json
+import os
+import time
 import salt.utils
 
 try:
@@ -39,7 +48,9 @@ __outputter__ = {
     'schema_drop': 'txt',
     'tables': 'yaml',
     'table_find': 'yaml',
-    'query': 'txt'
+    'catalog': 'yaml',
+    'query': 'txt',
+    'execute': 'yaml'
 }
 __opts__ = __salt__['test.get_opts']()
 
@@ -63,13 +74,11 @@ def __virtual__():
 
 
 # Helper functions
-def _connect(**dsn):
+def _dsn(**dsn):
     '''
-    This method is used to establish a connection
-    and returns the connection
+    Build the connection arguments from the given values
+    and the drizzle.* options
     '''
-
-    # Initializing the required variables
     dsn_url = {}
     parameter = ['host', 'user', 'passwd', 'db', 'port']
 
@@ -79,12 +88,71 @@ def _connect(**dsn):
             dsn_url[param] = dsn[param]
         else:
             dsn_url[param] = __opts__['drizzle.{0}'.format(param)]
+    return dsn_url
+
+
+def _connect(**dsn):
+    '''
+    This method is used to establish a connection
+    and returns the connection
+
+    Connections come from a per-DSN pool kept in __context__ and must be
+    handed back with _release(). A pooled connection is only reused if it
+    has not been idle for too long and still answers a ping.
+    '''
+    dsn_url = _dsn(**dsn)
+    key = tuple(sorted(dsn_url.items()))
+    pool = __context__.setdefault('drizzle.pool', {}).setdefault(key, [])
+    max_idle = __opts__.get('drizzle.pool_max_idle', 300)
+
+    now = time.time()
+    while pool:
+        drizzle_db, released = pool.pop()
+        if now - released > max_idle:
+            _close(drizzle_db)
+            continue
+        try:
+            drizzle_db.ping()
+        except MySQLdb.Error:
+            _close(drizzle_db)
+            continue
+        return drizzle_db
+
     # Connecting to Drizzle!
     drizzle_db = MySQLdb.connect(**dsn_url)
     drizzle_db.autocommit(True)
+    drizzle_db.salt_pool_key = key
     return drizzle_db
 
 
+def _release(drizzle_db, cursor=None):
+    '''
+    Hand a connection from _connect() back to its pool
+    '''
+    if cursor is not None:
+        cursor.close()
+    pool = __context__.setdefault('drizzle.pool', {}).setdefault(
+            drizzle_db.salt_pool_key, [])
+    if len(pool) >= __opts__.get('drizzle.pool_size', 4):
+        _close(drizzle_db)
+    else:
+        pool.append((drizzle_db, time.time()))
+
+
+def _close(drizzle_db):
+    try:
+        drizzle_db.close()
+    except MySQLdb.Error:
+        pass
+
+
+def _quote_identifier(name):
+    '''
+    Quote a schema or table name, identifiers cannot be query parameters
+    '''
+    return '`{0}`'.format(name.replace('`', '``'))
+
+
 # Server functions
 def status():
     '''
@@ -102,13 +170,12 @@ def status():
     cursor = drizzle_db.cursor()
 
     # Fetching status
-    cursor.execute('SHOW STATUS')
-    for iter in range(cursor.rowcount):
-        status = cursor.fetchone()
-        ret_val[status[0]] = status[1]
-
-    cursor.close()
-    drizzle_db.close()
+    try:
+        cursor.execute('SHOW STATUS')
+        for status in cursor.fetchall():
+            ret_val[status[0]] = status[1]
+    finally:
+        _release(drizzle_db, cursor)
     return ret_val
 
 
@@ -126,11 +193,11 @@ def version():
     cursor = drizzle_db.cursor(MySQLdb.cursors.DictCursor)
 
     # Fetching version
-    cursor.execute('SELECT VERSION()')
-    version = cursor.fetchone()
-
-    cursor.close()
-    drizzle_db.close()
+    try:
+        cursor.execute('SELECT VERSION()')
+        version = cursor.fetchone()
+    finally:
+        _release(drizzle_db, cursor)
     return version
 
 
@@ -151,13 +218,12 @@ def schemas():
     cursor = drizzle_db.cursor()
 
     # Retriving the list of schemas
-    cursor.execute('SHOW SCHEMAS')
-    for iter, count in zip(range(cursor.rowcount),range(1,cursor.rowcount+1)):
-        schema = cursor.fetchone()
-        ret_val[count] = schema[0]
-
-    cursor.close()
-    drizzle_db.close()
+    try:
+        cursor.execute('SHOW SCHEMAS')
+        for count, schema in enumerate(cursor.fetchall(), 1):
+            ret_val[count] = schema[0]
+    finally:
+        _release(drizzle_db, cursor)
     return ret_val
 
 
@@ -175,11 +241,13 @@ def schema_exists(schema):
     cursor = drizzle_db.cursor()
 
     # Checking for existance
-    cursor.execute('SHOW SCHEMAS LIKE "{0}"'.format(schema))
-    cursor.fetchall()
-    if cursor.rowcount == 1:
-        return True
-    return False
+    try:
+        cursor.execute('SHOW SCHEMAS LIKE %s', (schema,))
+        cursor.fetchall()
+        exists = cursor.rowcount == 1
+    finally:
+        _release(drizzle_db, cursor)
+    return exists
 
 
 def schema_create(schema):
@@ -197,12 +265,13 @@ def schema_create(schema):
 
     # Creating schema
     try:
-        cursor.execute('CREATE SCHEMA {0}'.format(schema))
+        cursor.execute('CREATE SCHEMA {0}'.format(_quote_identifier(schema)))
     except MySQLdb.ProgrammingError:
         return 'Schema already exists'
+    finally:
+        _release(drizzle_db, cursor)
+    _catalog_invalidate()
 
-    cursor.close()
-    drizzle_db.close()
     return True
 
 
@@ -221,15 +290,52 @@ def schema_drop(schema):
 
     # Dropping schema
     try:
-        cursor.execute('DROP SCHEMA {0}'.format(schema))
+        cursor.execute('DROP SCHEMA {0}'.format(_quote_identifier(schema)))
     except MySQLdb.OperationalError:
         return 'Schema does not exist'
+    finally:
+        _release(drizzle_db, cursor)
+    _catalog_invalidate()
 
-    cursor.close()
-    drizzle_db.close()
     return True
 
 
+def _catalog_snapshot(refresh=False):
+    '''
+    Return every schema with its tables, row estimates and sizes, read
+    with a single information_schema query and cached in __context__ for
+    drizzle.catalog_ttl seconds (60 by default)
+    '''
+    cached = __context__.get('drizzle.catalog')
+    ttl = __opts__.get('drizzle.catalog_ttl', 60)
+    if cached is not None and not refresh and time.time() - cached[0] < ttl:
+        return cached[1]
+
+    drizzle_db = _connect()
+    cursor = drizzle_db.cursor()
+    try:
+        cursor.execute('SELECT s.SCHEMA_NAME, t.TABLE_NAME, t.TABLE_ROWS, '
+                       't.DATA_LENGTH, t.INDEX_LENGTH '
+                       'FROM INFORMATION_SCHEMA.SCHEMATA s '
+                       'LEFT JOIN INFORMATION_SCHEMA.TABLES t '
+                       'ON t.TABLE_SCHEMA = s.SCHEMA_NAME '
+                       'ORDER BY s.SCHEMA_NAME, t.TABLE_NAME')
+        snapshot = {}
+        for schema, table, rows, data_length, index_length in cursor.fetchall():
+            entries = snapshot.setdefault(schema, {})
+            if table is not None:
+                entries[table] = (rows, data_length, index_length)
+    finally:
+        _release(drizzle_db, cursor)
+
+    __context__['drizzle.catalog'] = (time.time(), snapshot)
+    return snapshot
+
+
+def _catalog_invalidate():
+    __context__.pop('drizzle.catalog', None)
+
+
 def tables(schema):
     '''
     Displays all the tables that are
@@ -240,23 +346,13 @@ def tables(schema):
         salt '*' drizzle.tables schema_name
     '''
 
-    # Initializing the required variables
-    ret_val = {}
-    drizzle_db = _connect()
-    cursor = drizzle_db.cursor()
-
-    # Fetching tables
-    try:
-        cursor.execute('SHOW TABLES IN {0}'.format(schema))
-    except MySQLdb.OperationalError:
+    snapshot = _catalog_snapshot()
+    if schema not in snapshot:
         return 'Unknown Schema'
 
-    for iter,count in zip(range(cursor.rowcount),range(1,cursor.rowcount+1)):
-        table = cursor.fetchone()
-        ret_val[count] = table[0]
-
-    cursor.close()
-    drizzle_db.close()
+    ret_val = {}
+    for count, table in enumerate(sorted(snapshot[schema]), 1):
+        ret_val[count] = table
     return ret_val
 
 
@@ -270,23 +366,41 @@ def table_find(table_to_find):
         salt '*' drizzle.table_find table_name
     '''
 
-    # Initializing the required variables
     ret_val = {}
     count = 1
-    drizzle_db = _connect()
-    cursor = drizzle_db.cursor()
+    snapshot = _catalog_snapshot()
+    for schema in sorted(snapshot):
+        if table_to_find in snapshot[schema]:
+            ret_val[count] = schema
+            count = count+1
+    return ret_val
+
+
+def catalog(refresh=False):
+    '''
+    Returns all schemas with their tables, estimated row counts and
+    sizes in bytes, fetched in a single round trip
 
-    # Finding the schema
-    schema = schemas()
-    for schema_iter in schema.iterkeys():
-        table = tables(schema[schema_iter])
-        for table_iter in table.iterkeys():
-            if table[table_iter] == table_to_find:
-                ret_val[count] = schema[schema_iter]
-                count = count+1
-
-    cursor.close()
-    drizzle_db.close()
+    CLI Example::
+
+        salt '*' drizzle.catalog
+        salt '*' drizzle.catalog refresh=True
+    '''
+
+    ret_val = {}
+    for schema, entries in _catalog_snapshot(refresh).items():
+        schema_size = 0
+        schema_tables = {}
+        for table, (rows, data_length, index_length) in entries.items():
+            size = (data_length or 0) + (index_length or 0)
+            schema_size += size
+            schema_tables[table] = {
+                'rows': rows,
+                'data_length': data_length,
+                'index_length': index_length,
+                'size': size,
+            }
+        ret_val[schema] = {'tables': schema_tables, 'size': schema_size}
     return ret_val
 
 
@@ -307,14 +421,13 @@ def plugins():
     cursor = drizzle_db.cursor()
 
     # Fetching the plugins
-    query = 'SELECT PLUGIN_NAME FROM DATA_DICTIONARY.PLUGINS WHERE IS_ACTIVE LIKE "YES"'
-    cursor.execute(query)
-    for iter,count in zip(range(cursor.rowcount),range(1,cursor.rowcount+1)):
-        table = cursor.fetchone()
-        ret_val[count] = table[0]
-
-    cursor.close()
-    drizzle_db.close()
+    query = 'SELECT PLUGIN_NAME FROM DATA_DICTIONARY.PLUGINS WHERE IS_ACTIVE LIKE %s'
+    try:
+        cursor.execute(query, ('YES',))
+        for count, table in enumerate(cursor.fetchall(), 1):
+            ret_val[count] = table[0]
+    finally:
+        _release(drizzle_db, cursor)
     return ret_val
 
 #TODO: Needs to add plugin_add() and plugin_remove() methods.
@@ -324,70 +437,230 @@ def plugins():
 
 
 # Query functions
-def query(schema, query):
+def _split_statements(sql):
+    '''
+    Split SQL text into statements on the semicolons which are not inside
+    a string, a quoted identifier or a comment. Like the server, only
+    treat -- as a comment when followed by whitespace or a control
+    character, so expressions like 1--1 are left alone.
+    '''
+    statements = []
+    current = []
+    quote = None
+    i = 0
+    length = len(sql)
+    while i < length:
+        char = sql[i]
+        if quote:
+            current.append(char)
+            if char == '\\' and quote != '`' and i + 1 < length:
+                current.append(sql[i + 1])
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in ('\'', '"', '`'):
+            quote = char
+            current.append(char)
+        elif (sql.startswith('--', i) and
+              (i + 2 == length or sql[i + 2] <= ' ')) or char == '#':
+            end = sql.find('\n', i)
+            i = length if end == -1 else end
+            continue
+        elif sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            i = length if end == -1 else end + 2
+            current.append(' ')
+            continue
+        elif char == ';':
+            statements.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+        i += 1
+    statements.append(''.join(current))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+# Canonical names of the MySQLdb field types; FIELD_TYPE also has aliases
+# such as CHAR for TINY and INTERVAL for ENUM which share their codes
+_FIELD_TYPE_NAMES = ('DECIMAL', 'TINY', 'SHORT', 'LONG', 'FLOAT', 'DOUBLE',
+                     'NULL', 'TIMESTAMP', 'LONGLONG', 'INT24', 'DATE', 'TIME',
+                     'DATETIME', 'YEAR', 'NEWDATE', 'VARCHAR', 'BIT', 'JSON',
+                     'NEWDECIMAL', 'ENUM', 'SET', 'TINY_BLOB', 'MEDIUM_BLOB',
+                     'LONG_BLOB', 'BLOB', 'VAR_STRING', 'STRING', 'GEOMETRY')
+
+
+def _field_types():
+    '''
+    Map MySQLdb field type codes to their names
+    '''
+    from MySQLdb.constants import FIELD_TYPE
+    return dict((getattr(FIELD_TYPE, name), name) for name in _FIELD_TYPE_NAMES
+                if hasattr(FIELD_TYPE, name))
+
+
+def _output_path(output, number, count):
+    '''
+    File for the result set of the number-th of count statements: output
+    itself for a single statement, else output with the statement number
+    inserted before the extension
+    '''
+    if count == 1:
+        return output
+    root, ext = os.path.splitext(output)
+    return '{0}.{1}{2}'.format(root, number, ext)
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def query(schema, query, server_side=False, batch_size=1000, output=None, fmt='csv'):
     '''
     Query method is used to issue any query to the database.
     This method also supports multiple queries.
 
+    Returns one entry per statement, in order. Result sets come back as
+    ``columns`` (with their ``types``) and ``rows``; other statements report
+    the number of rows affected.
+
+    server_side
+        Use a server side cursor so large result sets are not buffered in
+        the minion's memory. Rows are read ``batch_size`` at a time.
+    output
+        Stream result rows to this file instead of returning them, as
+        ``csv`` or ``ndjson`` depending on ``fmt``. With several statements
+        each csv result set is written to its own file, named after output
+        with the statement number before the extension (``/tmp/out.2.csv``);
+        ndjson rows of all statements go to output.
+
     CLI Example::
 
         salt '*' drizzle.query test_db 'select * from test_table'
         salt '*' drizzle.query test_db 'insert into test_table values (1,"test1")'
+        salt '*' drizzle.query test_db 'select * from big_table' server_side=True output=/tmp/big.csv
     '''
 
-    # Initializing the required variables
-    ret_val = {}
-    result = {}
-    drizzle_db = _connect()
-    cursor = drizzle_db.cursor()
-    columns = ()
-    rows = ()
-    tuples = {}
-    queries = []
-    _entry = True
+    if fmt not in ('csv', 'ndjson'):
+        return 'Unknown output format {0}'.format(fmt)
+    queries = _split_statements(query)
+    field_types = _field_types()
+    ret_val = []
 
-    # Support for mutilple queries
-    queries = query.split(";")
-
-    # Using the schema
+    drizzle_db = _connect()
+    if server_side:
+        cursor = drizzle_db.cursor(MySQLdb.cursors.SSCursor)
+    else:
+        cursor = drizzle_db.cursor()
+    files = []
+    ndjson = None
     try:
-        cursor.execute('USE {0}'.format(schema))
-    except MySQLdb.Error:
-        return 'check your schema'
-
-    # Issuing the queries
-    for issue in queries:
+        # Using the schema
         try:
-            rows_affected = cursor.execute(issue)
+            drizzle_db.select_db(schema)
         except MySQLdb.Error:
-            return 'Error in your SQL statement'
+            return 'check your schema'
+
+        # Issuing the queries
+        for number, issue in enumerate(queries, 1):
+            try:
+                rows_affected = cursor.execute(issue)
+            except MySQLdb.Error:
+                return 'Error in your SQL statement'
+
+            result = {'statement': issue}
+            if cursor.description is None:
+                _catalog_invalidate()
+                result['rows affected'] = rows_affected
+                ret_val.append(result)
+                continue
+
+            columns = [column[0] for column in cursor.description]
+            result['columns'] = columns
+            result['types'] = [field_types.get(column[1], column[1])
+                               for column in cursor.description]
+            count = 0
+            rows = []
+            out = None
+            if output and fmt == 'csv':
+                path = _output_path(output, number, len(queries))
+                out = salt.utils.fopen(path, 'w')
+                files.append(out)
+                writer = csv.writer(out)
+                writer.writerow([_csv_value(column) for column in columns])
+            elif output:
+                if ndjson is None:
+                    ndjson = salt.utils.fopen(output, 'w')
+                    files.append(ndjson)
+                out = ndjson
+                path = output
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                count += len(batch)
+                if out is None:
+                    rows.extend(batch)
+                elif fmt == 'csv':
+                    writer.writerows([[_csv_value(value) for value in row]
+                                      for row in batch])
+                else:
+                    for row in batch:
+                        out.write(json.dumps(dict(zip(columns, row)),
+                                             default=str))
+                        out.write('\n')
+            if out is None:
+                result['rows'] = rows
+            else:
+                result['file'] = path
+            result['rows selected'] = count
+            ret_val.append(result)
+    finally:
+        for out in files:
+            out.close()
+        _release(drizzle_db, cursor)
 
-        # Checking whether the query is a SELECT
-        if re.search(r'\s*select',issue) is None:
-            result['Rows affected:'] = rows_affected
-            ret_val[issue.lower()] = result
-            result = {}
-            continue
+    return ret_val
 
-        # Fetching the column names
-        if _entry:
-            attributes = cursor.description
-            for column_names in attributes:
-                columns += (column_names[0],)
-            _entry = False
-        result['columns'] = columns
-
-        # Fetching the tuples
-        count = 1
-        for iter in range(cursor.rowcount):
-            row = cursor.fetchone()
-            result['row{0}'.format(count)] = row
-            count += 1
-        result['Rows selected:'] = count-1
-        ret_val[issue.lower()] = result
-        result = {}
 
-    return ret_val
+def execute(schema, statement, params=None, many=False):
+    '''
+    Run one parameterized statement. Values are passed separately from the
+    SQL as ``%s`` placeholders, so they are escaped by the driver instead of
+    being formatted into the statement.
+
+    With ``many`` the statement is run once per entry of ``params``; for
+    INSERT ... VALUES the driver sends all rows in a single statement.
+
+    Returns the columns and rows of a result set, or the affected row count.
+
+    CLI Example::
+
+        salt '*' drizzle.execute test_db 'select * from t where id = %s' params='[1]'
+        salt '*' drizzle.execute test_db 'insert into t values (%s, %s)' params='[[1, "a"], [2, "b"]]' many=True
+    '''
+
+    drizzle_db = _connect()
+    cursor = drizzle_db.cursor()
+    try:
+        drizzle_db.select_db(schema)
+        if many:
+            rows_affected = cursor.executemany(statement, params or [])
+        else:
+            rows_affected = cursor.execute(statement, params)
+        if cursor.description is None:
+            _catalog_invalidate()
+            return {'rows affected': rows_affected}
+        return {'columns': [column[0] for column in cursor.description],
+                'rows': [list(row) for row in cursor.fetchall()]}
+    except MySQLdb.Error as exc:
+        return 'Error in your SQL statement: {0}'.format(exc)
+    finally:
+        _release(drizzle_db, cursor)
 
 
 def ping():
@@ -27,6 +27,9 @@ ToDo::
 
 # System Imports
 import logging
+import os
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 log = logging.getLogger(__name__)
 
@@ -48,38 +51,117 @@ def _is_ietd_running():
     return True
 
 
-def _get_new_tid():
+def _iet_value(value):
     '''
-    Get a new Target ID, and make sure it is not in use
+    Convert numeric /proc/net/iet values to integers
+    '''
+    if value.isdigit():
+        return int(value)
+    return value
+
+
+def _parse_iet_line(line):
+    '''
+    Parse a "key:value key:value" line. A path is always the last field and
+    may contain spaces.
+    '''
+    fields = {}
+    if line.startswith('path:') or ' path:' in line:
+        line, path = (' ' + line).split(' path:', 1)
+        fields['path'] = path
+    for token in line.split():
+        key, _, value = token.partition(':')
+        fields[key] = _iet_value(value)
+    return fields
+
+
+def _parse_iet(path, levels):
+    '''
+    Parse one of the /proc/net/iet files in a single pass into a list of
+    targets. A line indented by n tabs is added to the list named levels[n-1]
+    of the last line one level up, e.g. the LUNs of a target or the
+    connections of a session.
+    '''
+    targets = []
+    parents = []
+    try:
+        fd_ = open(path)
+    except IOError:
+        log.error('Error: ({0}) could not be read'.format(path))
+        return targets
+    with fd_:
+        for line in fd_:
+            if not line.strip():
+                continue
+            depth = len(line) - len(line.lstrip('\t'))
+            entry = _parse_iet_line(line.strip())
+            del parents[depth:]
+            if depth == 0:
+                targets.append(entry)
+            elif len(parents) == depth:
+                parents[-1].setdefault(levels[depth - 1], []).append(entry)
+            else:
+                continue
+            if depth < len(levels):
+                entry.setdefault(levels[depth], [])
+            parents.append(entry)
+    return targets
+
+
+def _get_state(refresh=False):
+    '''
+    Read /proc/net/iet/volume and /proc/net/iet/session once into an indexed
+    model, kept in __context__ until a change is made through ietadm:
+
+        targets: tid -> {'tid', 'name', 'luns': [...], 'sessions': [...]}
+        iqns: iqn -> tid
     '''
-    tid = 1
-    with open('/proc/net/iet/volume') as fd_:
-        tids = [int(x__.split(' ')[0].split(':')[-1]) for x__ in fd_.readlines() if 'tid:' in x__]
+    if not refresh and 'iscsitarget.state' in __context__:
+        return __context__['iscsitarget.state']
 
-        # Get a new ID based on the max
-        # We avoid deleted TIDs as a stale iSCSI client may pick it up
-        # If you have lots of TIDs and need to reuse deleted ones you may
-        # want to alter this
-        if tids:
-            tid = max(tids) + 1
+    targets = {}
+    iqns = {}
+    for target in _parse_iet('/proc/net/iet/volume', ['luns']):
+        target['sessions'] = []
+        targets[target['tid']] = target
+        iqns[target['name']] = target['tid']
+    for target in _parse_iet('/proc/net/iet/session', ['sessions', 'connections']):
+        if target['tid'] in targets:
+            targets[target['tid']]['sessions'] = target['sessions']
 
-    return tid
+    state = {'targets': targets, 'iqns': iqns}
+    __context__['iscsitarget.state'] = state
+    return state
+
+
+def _invalidate_state():
+    '''
+    Forget the cached target model after ietadm changed it
+    '''
+    __context__.pop('iscsitarget.state', None)
+
+
+def _get_new_tid():
+    '''
+    Get a new Target ID, and make sure it is not in use
+    '''
+    # Get a new ID based on the max
+    # We avoid deleted TIDs as a stale iSCSI client may pick it up
+    # If you have lots of TIDs and need to reuse deleted ones you may
+    # want to alter this
+    tids = _get_state()['targets']
+    if tids:
+        return max(tids) + 1
+    return 1
 
 
 def _get_tid_from_iqn(iqn):
     '''
     Get a target ID using a full IQN
     '''
-    ret = 0
-    with open('/proc/net/iet/volume') as fd_:
-        lines = fd_.readlines()
-        for x__ in lines:
-            if iqn in x__:
-                ret = int(x__.split(' ')[0].split(':')[-1])
-                break
-        else:
-            log.error('Error: (proc/net/iet/volume) {0} not found'.format(iqn))
-
+    ret = _get_state()['iqns'].get(iqn, 0)
+    if not ret:
+        log.error('Error: (proc/net/iet/volume) {0} not found'.format(iqn))
     return ret
 
 
@@ -87,17 +169,22 @@ def _get_volumes(iqn):
     '''
     Get all volumes associated with target
     '''
-    with open('/proc/net/iet/volume') as fd_:
-        lines = fd_.read()
-        if iqn not in lines:
-            return []
-        config = lines.split(iqn)[-1]
-        config = config.split('tid:')[0].split('\n')[1:-1]
-        paths = []
-        for x__ in config:
-            paths.append(x__.split('path:')[-1].rstrip())
+    state = _get_state()
+    tid = state['iqns'].get(iqn)
+    if tid is None:
+        return []
+    return [lun['path'] for lun in state['targets'][tid]['luns']]
 
-    return paths
+
+def _config_target_index(clines, fiqn):
+    '''
+    Return the index of the Target line for fiqn in the config lines, or None
+    '''
+    for x__, line in enumerate(clines):
+        fields = line.split()
+        if fields and fields[0] == 'Target' and fiqn in fields[1:]:
+            return x__
+    return None
 
 
 def _get_params(kwargs):
@@ -147,12 +234,10 @@ def _config_delete_target(config, fiqn):
     '''
     with open(config, 'r+') as fd_:
         clines = fd_.readlines()
-        tgts = [x__ for x__ in range(len(clines)) if clines[x__].lstrip().startswith('Target')]
         # Find the Target
-        tgt = [x__ for x__ in tgts if fiqn in clines[x__]]
-        if tgt:
+        t__ = _config_target_index(clines, fiqn)
+        if t__ is not None:
             # Delete the whole target
-            t__ = tgt[0]
             while True:
                 del clines[t__]
                 # Delete until the end, or until the next Target definition
@@ -202,6 +287,7 @@ def _add_lun(tid, lun, path, iotype='blockio'):
     cmd = 'ietadm --op new --tid {0} --lun {1} --params Path={2},Type={3}'.format(
         tid, lun, path, iotype)
     out = __salt__['cmd.retcode'](cmd)
+    _invalidate_state()
     if out:
         log.error('ietadm({0}) Could not attach logical volume to target {1}'.format(
                 out, path))
@@ -218,12 +304,11 @@ def _config_add_lun(config, fiqn, lun, vg_, name, iotype='blockio'):
 
     with open(config, 'r+') as fd_:
         clines = fd_.readlines()
-        tgts = [x__ for x__ in range(len(clines)) if clines[x__].lstrip().startswith('Target')]
 
         # find the target
-        tgt = [x__ for x__ in tgts if fiqn in clines[x__]]
-        if tgt:
-            t__ = tgt[0] + 1
+        tgt = _config_target_index(clines, fiqn)
+        if tgt is not None:
+            t__ = tgt + 1
             while (t__ < len(clines) and clines[t__].lstrip().startswith('Lun')):
                 t__ += 1
             clines.insert(t__, nlun)
@@ -241,6 +326,7 @@ def _delete_lun(tid, lun):
     # Remove the LUN from the target
     cmd = 'ietadm --op delete --tid {0} --lun {1}'.format(tid, lun)
     out = __salt__['cmd.retcode'](cmd)
+    _invalidate_state()
     if out:
         log.error('ietadm({0}) Could not delete LUN {1} on target {2}'.format(out, lun, tid))
         return False
@@ -253,14 +339,13 @@ def _config_delete_lun(config, fiqn, lun, rtarget=False):
     '''
     with open(config, 'r+') as fd_:
         clines = fd_.readlines()
-        tgts = [x__ for x__ in range(len(clines)) if clines[x__].lstrip().startswith('Target')]
         # Find the Target
-        tgt = [x__ for x__ in tgts if fiqn in clines[x__]]
-        if tgt:
+        tgt = _config_target_index(clines, fiqn)
+        if tgt is not None:
             # Delete just the LUN
-            t__ = tgt[0] + 1
+            t__ = tgt + 1
             while (t__ < len(clines) and clines[t__].lstrip().startswith('Lun')):
-                if 'Lun {0}'.format(lun) in clines[t__]:
+                if clines[t__].split()[1:2] == [str(lun)]:
                     del clines[t__]
                 else:
                     t__ += 1
@@ -268,6 +353,118 @@ def _config_delete_lun(config, fiqn, lun, rtarget=False):
         _rewrite_config(fd_, clines)
 
 
+def _create_target(tid, fiqn):
+    '''
+    Create a Target with ietadm
+    '''
+    cmd = 'ietadm --op new --tid {0} --params Name={1}'.format(tid, fiqn)
+    out = __salt__['cmd.retcode'](cmd)
+    _invalidate_state()
+    if out:
+        log.error('ietadm({0}) Could not create iSCSI Target {1}'.format(out, fiqn))
+        return False
+    return True
+
+
+def _remove_target(tid):
+    '''
+    Delete a Target with ietadm
+    '''
+    cmd = 'ietadm --op delete --tid {0}'.format(tid)
+    out = __salt__['cmd.retcode'](cmd)
+    _invalidate_state()
+    if out:
+        log.error('ietadm({0}) Could not delete target {1}'.format(out, tid))
+        return False
+    return True
+
+
+def _config_blocks(clines):
+    '''
+    Split config lines into the lines before the first Target and one block
+    of lines per Target, keyed by IQN
+    '''
+    head = []
+    blocks = []
+    for line in clines:
+        fields = line.split()
+        if fields and fields[0] == 'Target':
+            blocks.append((fields[-1], [line]))
+        elif blocks:
+            blocks[-1][1].append(line)
+        else:
+            head.append(line)
+    return head, blocks
+
+
+def _write_config_atomic(config, lines):
+    '''
+    Replace the configuration file in one step: write a temporary file next
+    to it and rename it over the original
+    '''
+    dirname = os.path.dirname(os.path.abspath(config))
+    fd_, tmp = tempfile.mkstemp(prefix='.ietd.conf.', dir=dirname)
+    try:
+        with os.fdopen(fd_, 'w') as tf_:
+            tf_.write(''.join(lines))
+            tf_.flush()
+            os.fsync(tf_.fileno())
+        if os.path.exists(config):
+            os.chmod(tmp, os.stat(config).st_mode & 0o7777)
+        os.rename(tmp, config)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _config_provision(config, targets, luns):
+    '''
+    Add new targets and LUNs to the config file with a single rewrite.
+    targets is a list of (tid, fiqn), luns a list of (fiqn, lun, path, iotype).
+    '''
+    if os.path.exists(config):
+        with open(config) as fd_:
+            clines = fd_.readlines()
+    else:
+        clines = []
+    if clines and not clines[-1].endswith('\n'):
+        clines[-1] += '\n'
+    head, blocks = _config_blocks(clines)
+    index = dict((fiqn, block) for fiqn, block in blocks)
+
+    for tid, fiqn in targets:
+        if fiqn not in index:
+            index[fiqn] = ['Target {0} {1}\n'.format(tid, fiqn)]
+            blocks.append((fiqn, index[fiqn]))
+    for fiqn, lun, path, iotype in luns:
+        block = index[fiqn]
+        # keep the Lun lines together, right below the Target line
+        t__ = 1
+        while t__ < len(block) and block[t__].lstrip().startswith('Lun'):
+            t__ += 1
+        block.insert(t__, '\tLun {0} PATH={1},Type={2}\n'.format(lun, path, iotype))
+
+    lines = list(head)
+    for fiqn, block in blocks:
+        lines.extend(block)
+    _write_config_atomic(config, lines)
+
+
+def _pool_map(func, args, workers):
+    '''
+    Run func over args with at most workers threads, results in order
+    '''
+    if not args:
+        return []
+    pool = ThreadPool(max(1, min(int(workers), len(args))))
+    try:
+        return pool.map(lambda arg: func(*arg), args)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def add_target(name, **kwargs):
     '''
     Add an iSCSI target. A target ID will be chosen automatically and
@@ -321,14 +518,8 @@ def add_target(name, **kwargs):
     tid = _get_new_tid()
 
     # Create the iscsi target
-    cmd = 'ietadm --op new --tid {0} --params Name={1}'.format(tid, fiqn)
-    out = __salt__['cmd.retcode'](cmd)
-    if out:
-        return {
-            'Error': 'ietadm({0}) Could not create iSCSI Target {1}'.format(
-                out, fiqn
-            )
-        }
+    if not _create_target(tid, fiqn):
+        return {'Error': '(ietadm) Could not create iSCSI Target {0}'.format(fiqn)}
 
     # Add target to config
     _config_add_target(config, tid, fiqn)
@@ -386,12 +577,8 @@ def delete_target(name, **kwargs):
     vols = _get_volumes(fiqn)
 
     # Remove the target
-    cmd = 'ietadm --op delete --tid {0}'.format(tid)
-    out = __salt__['cmd.retcode'](cmd)
-    if out:
-        return {
-            'Error': 'ietadm({0}) Could not delete target {1}'.format(out, fiqn)
-        }
+    if not _remove_target(tid):
+        return {'Error': '(ietadm) Could not delete target {0}'.format(fiqn)}
 
     # Remove the configuration
     _config_delete_target(config, fiqn)
@@ -498,27 +685,176 @@ def delete_lun(name, lun, **kwargs):
 
 def list_volumes():
     '''
-    Get iSCSI Target volume information
+    Get iSCSI Target volume information as a list of targets, ordered by
+    target ID, each with its LUNs
 
     CLI Example::
 
         salt \* iscsitarget.list_volumes
     '''
-    # Directly return the contents of the kernel params
-    # TODO: Parse the output and make it machine readable
-    with open('/proc/net/iet/volume') as fd_:
-        return fd_.read()
+    targets = _get_state(refresh=True)['targets']
+    return [{'tid': tid,
+             'name': targets[tid]['name'],
+             'luns': targets[tid]['luns']}
+            for tid in sorted(targets)]
 
 
 def list_sessions():
     '''
-    Get iSCSI Target session information
+    Get iSCSI Target session information as a list of targets, ordered by
+    target ID, each with its sessions and their connections
 
     CLI Example::
 
         salt \* iscsitarget.list_sessions
     '''
-    # Directly return the content of the kernel params
-    # TODO: Parse the output and make it readable
-    with open('/proc/net/iet/session') as fd_:
-        return fd_.read()
+    targets = _get_state(refresh=True)['targets']
+    return [{'tid': tid,
+             'name': targets[tid]['name'],
+             'sessions': targets[tid]['sessions']}
+            for tid in sorted(targets)]
+
+
+def _provision_plan(targets, iqn_base, vg_, iotype):
+    '''
+    Work out the targets and LUNs which do not exist yet
+    '''
+    state = _get_state(refresh=True)
+    next_tid = _get_new_tid()
+    plan = {'targets': [], 'luns': []}
+    for target in targets:
+        if not isinstance(target, dict):
+            target = {'name': target}
+        fiqn = '{0}:{1}'.format(iqn_base, target['name'])
+        tid = state['iqns'].get(fiqn)
+        existing = set()
+        if tid is None:
+            tid = next_tid
+            next_tid += 1
+            plan['targets'].append({'tid': tid, 'iqn': fiqn})
+        else:
+            existing = set(lun['lun'] for lun in state['targets'][tid]['luns'])
+        luns = target.get('luns', [])
+        if isinstance(luns, dict):
+            luns = [{'lun': lun, 'size': size} for lun, size in sorted(luns.items())]
+        for lun in luns:
+            if int(lun['lun']) in existing:
+                continue
+            vn_ = '{0}_{1}'.format(target['name'], lun['lun'])
+            plan['luns'].append({
+                'tid': tid,
+                'iqn': fiqn,
+                'lun': int(lun['lun']),
+                'size': lun['size'],
+                'volume': vn_,
+                'path': '/dev/{0}/{1}'.format(vg_, vn_),
+                'iotype': lun.get('iotype', iotype),
+            })
+    return plan
+
+
+def _provision_rollback(vg_, volumes, targets, luns):
+    '''
+    Undo a partial provisioning run, newest changes first
+    '''
+    failed = []
+    for lun in reversed(luns):
+        if not _delete_lun(lun['tid'], lun['lun']):
+            failed.append('lun {0} of target {1}'.format(lun['lun'], lun['tid']))
+    for target in reversed(targets):
+        if not _remove_target(target['tid']):
+            failed.append('target {0}'.format(target['iqn']))
+    for volume in reversed(volumes):
+        if not _delete_vol(volume, vg_):
+            failed.append('volume {0}'.format(volume))
+    return failed
+
+
+def provision(targets, workers=4, dry_run=False, iotype='blockio', **kwargs):
+    '''
+    Create many targets and LUNs in one run. The logical volumes are created
+    in parallel, the targets and LUNs are then added with ietadm and the
+    config file is rewritten once, atomically. Targets and LUNs that already
+    exist are left alone. If any step fails, everything created so far is
+    removed again.
+
+    targets
+      A list of targets, each a name or a dict with a name and luns. luns
+      is a list of dicts with lun, size and optionally iotype, or a dict
+      mapping LUN to size (required)
+
+    workers
+      How many lvcreate commands to run at the same time (optional)
+
+    dry_run
+      Only return what would be created (optional)
+
+    iotype
+      Default IO type of the LUNs (optional)
+
+    The iqn_base, volgroup and config settings work as for add_target.
+
+    CLI Example::
+
+        salt \* iscsitarget.provision '[{name: tenant1, luns: {0: 10G, 1: 20G}}, tenant2]'
+    '''
+    # Check that ietd is running
+    if not _is_ietd_running():
+        return {'Error': '(ietd) ietd not active'}
+
+    iqn_base, vg_, config, opts = _get_params(kwargs)
+    plan = _provision_plan(targets, iqn_base, vg_, iotype)
+    if dry_run:
+        return {'Test': 'Would create {0} targets and {1} luns'.format(
+                    len(plan['targets']), len(plan['luns'])),
+                'changes': plan}
+    if not plan['targets'] and not plan['luns']:
+        return {'Success': 'All targets and luns already exist', 'changes': plan}
+
+    created_vols = []
+    created_targets = []
+    added_luns = []
+
+    def _fail(message):
+        failed = _provision_rollback(vg_, created_vols, created_targets, added_luns)
+        ret = {'Error': message}
+        if failed:
+            ret['Error'] += '; rollback failed for {0}'.format(', '.join(failed))
+        return ret
+
+    # Create the logical volumes
+    results = _pool_map(_create_vol,
+                        [(lun['volume'], lun['size'], vg_) for lun in plan['luns']],
+                        workers)
+    for lun, result in zip(plan['luns'], results):
+        if result:
+            created_vols.append(lun['volume'])
+    if len(created_vols) != len(plan['luns']):
+        missing = [lun['volume'] for lun, result in zip(plan['luns'], results)
+                   if not result]
+        return _fail('Could not create volumes {0} in {1}'.format(
+            ', '.join(missing), vg_))
+
+    # Create the targets and attach the volumes
+    for target in plan['targets']:
+        if not _create_target(target['tid'], target['iqn']):
+            return _fail('Could not create iSCSI Target {0}'.format(target['iqn']))
+        created_targets.append(target)
+    for lun in plan['luns']:
+        if not _add_lun(lun['tid'], lun['lun'], lun['path'], lun['iotype']):
+            return _fail('Could not add lun {0} to target {1}'.format(
+                lun['lun'], lun['tid']))
+        added_luns.append(lun)
+
+    # Update config file
+    try:
+        _config_provision(config,
+                          [(target['tid'], target['iqn']) for target in plan['targets']],
+                          [(lun['iqn'], lun['lun'], lun['path'], lun['iotype'])
+                           for lun in plan['luns']])
+    except (IOError, OSError) as exc:
+        return _fail('Could not update {0}: {1}'.format(config, exc))
+
+    return {'Success': 'Created {0} targets and {1} luns'.format(
+                len(plan['targets']), len(plan['luns'])),
+            'changes': plan}
@@ -16,8 +16,16 @@ Module for handling openstack keystone calls.
 
         keystone.token: 'ADMIN'
         keystone.endpoint: 'http://127.0.0.1:35357/v2.0'
+
+    The authenticated client is kept in ``__context__`` and reused by every
+    call of the same job until its token is about to expire.
 '''
 
+# Import python libs
+import itertools
+import threading
+from multiprocessing.pool import ThreadPool
+
 # Import third party libs
 HAS_KEYSTONE = False
 try:
@@ -28,6 +36,21 @@ try:
 except ImportError:
     pass
 
+HAS_SESSION = False
+try:
+    # keystoneclient >= 0.4.2 can share a pooled requests session
+    from keystoneclient.session import Session
+    HAS_SESSION = True
+except ImportError:
+    pass
+
+# Re-authenticate when the cached token expires within this many seconds
+_TOKEN_STALE_SECONDS = 60
+
+# Guards the client, name index and stats kept in __context__, which
+# keystone states update from several threads at once
+_CONTEXT_LOCK = threading.RLock()
+
 def __virtual__():
     '''
     Only load this module if keystone
@@ -40,11 +63,9 @@ def __virtual__():
 __opts__ = {}
 
 
-def auth():
+def _auth_kwargs():
     '''
-    Set up keystone credentials.  
-
-    Only intended to be used within Keystone-enabled modules.
+    Build the client arguments from the keystone.* options
     '''
     user = __salt__['config.option']('keystone.user')
     password = __salt__['config.option']('keystone.password')
@@ -69,7 +90,131 @@ def auth():
                 'auth_url': auth_url,
                 'insecure': insecure,
                 }
-    return client.Client(**kwargs)
+    return kwargs
+
+
+def _token_expiring(kstone):
+    '''
+    Check whether the token of a cached client is about to expire. Clients
+    using a static admin token never expire.
+    '''
+    auth_ref = getattr(kstone, 'auth_ref', None)
+    if auth_ref is None:
+        return False
+    return auth_ref.will_expire_soon(stale_duration=_TOKEN_STALE_SECONDS)
+
+
+def auth():
+    '''
+    Set up keystone credentials.  
+
+    Only intended to be used within Keystone-enabled modules.
+
+    The client is cached in __context__ and handed out again, without a new
+    token request, for as long as the credentials are unchanged and the
+    token is not about to expire.
+    '''
+    kwargs = _auth_kwargs()
+    key = tuple(sorted(kwargs.items()))
+    with _CONTEXT_LOCK:
+        stats = __context__.setdefault('keystone.auth_stats',
+                                       {'requests': 0, 'avoided': 0})
+        cached = __context__.get('keystone.client')
+        if cached is not None and cached[0] == key \
+                and not _token_expiring(cached[1]):
+            stats['avoided'] += 1
+            return cached[1]
+
+        if HAS_SESSION:
+            if 'keystone.session' not in __context__:
+                __context__['keystone.session'] = Session(
+                        verify=not kwargs.get('insecure'))
+            kwargs['session'] = __context__['keystone.session']
+        kstone = client.Client(**kwargs)
+        stats['requests'] += 1
+        __context__['keystone.client'] = (key, kstone)
+        return kstone
+
+
+def auth_stats():
+    '''
+    Return how many keystone authentications this job made and how many
+    were avoided by reusing the cached client
+
+    CLI Example::
+
+        salt '*' keystone.auth_stats
+    '''
+    with _CONTEXT_LOCK:
+        return dict(__context__.get('keystone.auth_stats',
+                                    {'requests': 0, 'avoided': 0}))
+
+
+def _index_load(collection, items):
+    '''
+    Replace the name -> id index of a collection from a full listing
+    '''
+    index = {}
+    for item in items:
+        index[item.name] = item.id
+    with _CONTEXT_LOCK:
+        __context__.setdefault('keystone.index', {})[collection] = index
+    return index
+
+
+def _index(kstone, collection):
+    '''
+    Return the name -> id index of users, tenants, roles or services,
+    listing the collection only the first time it is needed in a job
+    '''
+    with _CONTEXT_LOCK:
+        stats = __context__.setdefault('keystone.index_stats',
+                                       {'lists': 0, 'hits': 0})
+        index = __context__.setdefault('keystone.index', {}).get(collection)
+        if index is None:
+            # listed under the lock so concurrent callers wait for one
+            # listing instead of each making their own
+            stats['lists'] += 1
+            return _index_load(collection, getattr(kstone, collection).list())
+        stats['hits'] += 1
+        return index
+
+
+def _resolve(kstone, collection, name, default=None):
+    '''
+    Resolve a name to its id, returning default if there is no such name
+    '''
+    with _CONTEXT_LOCK:
+        return _index(kstone, collection).get(name, default)
+
+
+def _index_add(collection, name, id):  # pylint: disable-msg=C0103
+    with _CONTEXT_LOCK:
+        index = __context__.get('keystone.index', {}).get(collection)
+        if index is not None:
+            index[name] = id
+
+
+def _index_remove(collection, id):  # pylint: disable-msg=C0103
+    with _CONTEXT_LOCK:
+        index = __context__.get('keystone.index', {}).get(collection)
+        if index is not None:
+            for name in [n for n, i in index.items() if i == id]:
+                del index[name]
+
+
+def index_stats():
+    '''
+    Return how many full collection listings this job made to resolve names
+    and how many lookups were answered from the cached name index instead
+
+    CLI Example::
+
+        salt '*' keystone.index_stats
+    '''
+    with _CONTEXT_LOCK:
+        return dict(__context__.get('keystone.index_stats',
+                                    {'lists': 0, 'hits': 0}))
 
 def ec2_credentials_get(id=None,       # pylint: disable-msg=C0103
                         name=None,
@@ -86,10 +231,7 @@ def ec2_credentials_get(id=None,       # pylint: disable-msg=C0103
     kstone = auth()
     ret = {}
     if name:
-        for user in kstone.users.list():
-            if user.name == name:
-                id = user.id  # pylint: disable-msg=C0103
-                continue
+        id = _resolve(kstone, 'users', name, id)  # pylint: disable-msg=C0103
     if not id:
         return {'Error': 'Unable to resolve user id'}
     if not access:
@@ -117,10 +259,7 @@ def ec2_credentials_list(id=None, name=None):  # pylint: disable-msg=C0103
     kstone = auth()
     ret = {}
     if name:
-        for user in kstone.users.list():
-            if user.name == name:
-                id = user.id  # pylint: disable-msg=C0103
-                continue
+        id = _resolve(kstone, 'users', name, id)  # pylint: disable-msg=C0103
     if not id:
         return {'Error': 'Unable to resolve user id'}
     for ec2_credential in kstone.ec2.list(id):
@@ -180,10 +319,7 @@ def role_get(id=None, name=None):  # pylint: disable-msg=C0103
     kstone = auth()
     ret = {}
     if name:
-        for role in kstone.roles.list():
-            if role.name == name:
-                id = role.id  # pylint: disable-msg=C0103
-                continue
+        id = _resolve(kstone, 'roles', name, id)  # pylint: disable-msg=C0103
     if not id:
         return {'Error': 'Unable to resolve role id'}
     role = kstone.roles.get(id)
@@ -206,6 +342,7 @@ def role_create(name):
     item = kstone.roles.create(
             name=name,
             )
+    _index_add('roles', name, item.id)
     return role_get(item.id)
 
 def role_delete(id=None, name=None):  # pylint: disable-msg=C0103
@@ -220,13 +357,11 @@ def role_delete(id=None, name=None):  # pylint: disable-msg=C0103
     '''
     kstone = auth()
     if name:
-        for role in kstone.roles.list():
-            if role.name == name:
-                id = role.id  # pylint: disable-msg=C0103
-                continue
+        id = _resolve(kstone, 'roles', name, id)  # pylint: disable-msg=C0103
     if not id:
         return {'Error': 'Unable to resolve tenant id'}
     kstone.roles.delete(id)
+    _index_remove('roles', id)
     ret = 'Role ID {0} deleted'.format(id)
     if name:
       ret += ' ({0})'.format(name)
@@ -242,7 +377,9 @@ def role_list():
     '''
     kstone = auth()
     ret = {}
-    for role in kstone.roles.list():
+    roles = kstone.roles.list()
+    _index_load('roles', roles)
+    for role in roles:
         ret[role.name] = {
                 'id': role.id,
                 'name': role.name,
@@ -263,10 +400,7 @@ def service_get(id=None, name=None):  # pylint: disable-msg=C0103
     kstone = auth()
     ret = {}
     if name:
-        for service in kstone.services.list():
-            if service.name == name:
-                id = service.id  # pylint: disable-msg=C0103
-                continue
+        id = _resolve(kstone, 'services', name, id)  # pylint: disable-msg=C0103
     if not id:
         return {'Error': 'Unable to resolve service id'}
     service = kstone.services.get(id)
@@ -289,7 +423,9 @@ def service_list():
     '''
     kstone = auth()
     ret = {}
-    for service in kstone.services.list():
+    services = kstone.services.list()
+    _index_load('services', services)
+    for service in services:
         ret[service.name] = {
                 'id': service.id,
                 'name': service.name,
@@ -312,10 +448,7 @@ def tenant_get(id=None, name=None):  # pylint: disable-msg=C0103
     kstone = auth()
     ret = {}
     if name:
-        for tenant in kstone.tenants.list():
-            if tenant.name == name:
-                id = tenant.id  # pylint: disable-msg=C0103
-                continue
+        id = _resolve(kstone, 'tenants', name, id)  # pylint: disable-msg=C0103
     if not id:
         return {'Error': 'Unable to resolve tenant id'}
     tenant = kstone.tenants.get(id)
@@ -342,6 +475,7 @@ def tenant_create(name, description=None, enabled=True):
             description=description,
             enabled=enabled,
             )
+    _index_add('tenants', name, item.id)
     return tenant_get(item.id)
 
 def tenant_delete(id=None, name=None):  # pylint: disable-msg=C0103
@@ -356,13 +490,11 @@ def tenant_delete(id=None, name=None):  # pylint: disable-msg=C0103
     '''
     kstone = auth()
     if name:
-        for tenant in kstone.tenants.list():
-            if tenant.name == name:
-                id = tenant.id  # pylint: disable-msg=C0103
-                continue
+        id = _resolve(kstone, 'tenants', name, id)  # pylint: disable-msg=C0103
     if not id:
         return {'Error': 'Unable to resolve tenant id'}
     kstone.tenants.delete(id)
+    _index_remove('tenants', id)
     ret = 'Tenant ID {0} deleted'.format(id)
     if name:
       ret += ' ({0})'.format(name)
@@ -378,7 +510,9 @@ def tenant_list():
     '''
     kstone = auth()
     ret = {}
-    for tenant in kstone.tenants.list():
+    tenants = kstone.tenants.list()
+    _index_load('tenants', tenants)
+    for tenant in tenants:
         ret[tenant.name] = {
                 'id': tenant.id,
                 'name': tenant.name,
@@ -416,7 +550,9 @@ def user_list():
     '''
     kstone = auth()
     ret = {}
-    for user in kstone.users.list():
+    users = kstone.users.list()
+    _index_load('users', users)
+    for user in users:
         ret[user.name] = {
                 'id': user.id,
                 'name': user.name,
@@ -440,10 +576,7 @@ def user_get(id=None, name=None):  # pylint: disable-msg=C0103
     kstone = auth()
     ret = {}
     if name:
-        for user in kstone.users.list():
-            if user.name == name:
-                id = user.id  # pylint: disable-msg=C0103
-                continue
+        id = _resolve(kstone, 'users', name, id)  # pylint: disable-msg=C0103
     if not id:
         return {'Error': 'Unable to resolve user id'}
     user = kstone.users.get(id)
@@ -473,6 +606,7 @@ def user_create(name, password, email, tenant_id=None, enabled=True):
         tenant_id=tenant_id,
         enabled=enabled,
         )
+    _index_add('users', name, item.id)
     return user_get(item.id)
 
 
@@ -488,13 +622,11 @@ def user_delete(id=None, name=None):  # pylint: disable-msg=C0103
     '''
     kstone = auth()
     if name:
-        for user in kstone.users.list():
-            if user.name == name:
-                id = user.id  # pylint: disable-msg=C0103
-                continue
+        id = _resolve(kstone, 'users', name, id)  # pylint: disable-msg=C0103
     if not id:
         return {'Error': 'Unable to resolve user id'}
     kstone.users.delete(id)
+    _index_remove('users', id)
     ret = 'User ID {0} deleted'.format(id)
     if name:
         ret += ' ({0})'.format(name)
@@ -519,6 +651,9 @@ def user_update(id=None,        # pylint: disable-msg=C0103
     if not id:
         return {'Error': 'Unable to resolve user id'}
     kstone.users.update(user=id, name=name, email=email, enabled=enabled)
+    if name:
+        _index_remove('users', id)
+        _index_add('users', name, id)
     ret = 'Info updated for user ID {0}'.format(id)
     return ret
 
@@ -537,10 +672,7 @@ def user_password_update(id=None,         # pylint: disable-msg=C0103
     '''
     kstone = auth()
     if name:
-        for user in kstone.users.list():
-            if user.name == name:
-                id = user.id  # pylint: disable-msg=C0103
-                continue
+        id = _resolve(kstone, 'users', name, id)  # pylint: disable-msg=C0103
     if not id:
         return {'Error': 'Unable to resolve user id'}
     kstone.users.update_password(user=id, password=password)
@@ -567,15 +699,9 @@ def user_role_list(user_id=None,
     kstone = auth()
     ret = {}
     if user_name:
-        for user in kstone.users.list():
-            if user.name == user_name:
-                user_id = user.id
-                continue
+        user_id = _resolve(kstone, 'users', user_name, user_id)
     if tenant_name:
-        for tenant in kstone.tenants.list():
-            if tenant.name == tenant_name:
-                tenant_id = tenant.id
-                continue
+        tenant_id = _resolve(kstone, 'tenants', tenant_name, tenant_id)
     if not user_id and not tenant_id:
         return {'Error': 'Unable to resolve user or tenant id'}
     try:
@@ -588,6 +714,7 @@ def user_role_list(user_id=None,
                     }
     except NotFound:
         return {}
+    return ret
 
 def user_role_add(user_id=None,
                    user_name=None,
@@ -609,20 +736,11 @@ def user_role_add(user_id=None,
     kstone = auth()
     ret = {}
     if user_name:
-        for user in kstone.users.list():
-            if user.name == user_name:
-                user_id = user.id
-                continue
+        user_id = _resolve(kstone, 'users', user_name, user_id)
     if role_name:
-        for role in kstone.roles.list():
-            if role.name == role_name:
-                role_id = role.id
-                continue
+        role_id = _resolve(kstone, 'roles', role_name, role_id)
     if tenant_name:
-        for tenant in kstone.tenants.list():
-            if tenant.name == tenant_name:
-                tenant_id = tenant.id
-                continue
+        tenant_id = _resolve(kstone, 'tenants', tenant_name, tenant_id)
     if not user_id and not tenant_id and not role_id:
         return {'Error': 'Unable to resolve user, role or tenant id'}
     item = kstone.roles.add_user_role(user_id, role_id, tenant_id)
@@ -648,20 +766,11 @@ def user_role_remove(user_id=None,
     kstone = auth()
     ret = {}
     if user_name:
-        for user in kstone.users.list():
-            if user.name == user_name:
-                user_id = user.id
-                continue
+        user_id = _resolve(kstone, 'users', user_name, user_id)
     if role_name:
-        for role in kstone.roles.list():
-            if role.name == role_name:
-                role_id = role.id
-                continue
+        role_id = _resolve(kstone, 'roles', role_name, role_id)
     if tenant_name:
-        for tenant in kstone.tenants.list():
-            if tenant.name == tenant_name:
-                tenant_id = tenant.id
-                continue
+        tenant_id = _resolve(kstone, 'tenants', tenant_name, tenant_id)
     if not user_id and not tenant_id and not role_id:
         return {'Error': 'Unable to resolve user, role or tenant id'}
     kstone.roles.remove_user_role(user_id, role_id, tenant_id)
@@ -676,6 +785,103 @@ def user_role_remove(user_id=None,
         ret += '({0}) '.format(tenant_name)
     return ret
 
+def role_assignments(users=None, tenants=None, pairs=None, workers=8,
+                     limit=None):
+    '''
+    Return who has which role where, for many users and tenants at once
+
+    The roles of every (user, tenant) pair are fetched concurrently by at
+    most ``workers`` threads sharing one authenticated client, and collected
+    as they arrive. Only the members of each tenant are queried: the
+    members of the given ``tenants`` (all tenants by default) are listed
+    first by the same threads, restricted to ``users`` if given. ``pairs``
+    restricts the lookup to the given [user, tenant] name pairs instead.
+    The pairs are handed to the threads in bounded
+    batches, so only a few of them are queued or waiting to be collected at
+    any time however many users and tenants there are.
+
+    The result is a table of parallel lists, one entry per assignment, in
+    no particular order. Pairs which could not be queried are listed under
+    ``errors``. With ``limit`` no more pairs are queried once that many
+    assignments have been collected and ``truncated`` is set.
+
+    CLI Examples::
+
+        salt '*' keystone.role_assignments
+        salt '*' keystone.role_assignments users='[admin, demo]' workers=16
+        salt '*' keystone.role_assignments pairs='[[admin, admin]]'
+        salt '*' keystone.role_assignments limit=1000
+    '''
+    kstone = auth()
+    user_index = _index(kstone, 'users')
+    tenant_index = _index(kstone, 'tenants')
+    wanted_users = set(users) if users else None
+
+    def members(tenant):
+        tenant_id = tenant_index.get(tenant)
+        if tenant_id is None:
+            return tenant, [], 'Unable to resolve tenant id'
+        try:
+            found = kstone.tenants.list_users(tenant_id)
+        except ClientException as exc:
+            return tenant, [], str(exc)
+        return tenant, [user.name for user in found], None
+
+    def member_pairs(pool):
+        for tenant, names, error in pool.imap_unordered(
+                members, tenants or sorted(tenant_index)):
+            if error:
+                errors.append((None, tenant, error))
+            for user in names:
+                if wanted_users is None or user in wanted_users:
+                    yield user, tenant
+
+    def lookup(pair):
+        user, tenant = pair
+        user_id = user_index.get(user)
+        tenant_id = tenant_index.get(tenant)
+        if user_id is None or tenant_id is None:
+            return user, tenant, [], 'Unable to resolve user or tenant id'
+        try:
+            roles = kstone.roles.roles_for_user(user=user_id, tenant=tenant_id)
+        except NotFound:
+            return user, tenant, [], None
+        except ClientException as exc:
+            return user, tenant, [], str(exc)
+        return user, tenant, [role.name for role in roles], None
+
+    ret = {'user': [], 'tenant': [], 'role': []}
+    errors = []
+    workers = max(1, int(workers))
+    batch_size = workers * 32
+    pool = ThreadPool(workers)
+    try:
+        if pairs is None:
+            pairs = member_pairs(pool)
+        pairs = iter(pairs)
+        while True:
+            batch = list(itertools.islice(pairs, batch_size))
+            if not batch:
+                break
+            for user, tenant, roles, error in pool.imap_unordered(lookup, batch, 8):
+                if error:
+                    errors.append((user, tenant, error))
+                for role in roles:
+                    ret['user'].append(user)
+                    ret['tenant'].append(tenant)
+                    ret['role'].append(role)
+            if limit is not None and len(ret['role']) >= int(limit):
+                for key in ('user', 'tenant', 'role'):
+                    del ret[key][int(limit):]
+                ret['truncated'] = True
+                break
+    finally:
+        pool.close()
+        pool.join()
+    if errors:
+        ret['errors'] = errors
+    return ret
+
 def _item_list():
     '''
     Template for writing list functions
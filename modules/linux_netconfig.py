@@ -2,8 +2,14 @@
 Module to gather network configuration from Linux hosts
 """
 
+import logging
 import re
+import socket
+import struct
 import subprocess
+import time
+
+log = logging.getLogger(__name__)
 
 def __virtual__():
     """
@@ -182,17 +188,361 @@ def _structured_neigh_output(output):
 
     return res
 
-def links():
+def _ip_links():
     """
-    Return information about all network links on the system
+    PRIVATE METHOD
+    Return all links by parsing the output of "ip -o link show"
     """
     output = __salt__['cmd.run']('ip -o link show')
     return _structured_links_output(output)
 
+def _ip_addresses(options):
+    """
+    PRIVATE METHOD
+    Return addresses by parsing the output of "ip -o addr show"
+    """
+    output = __salt__['cmd.run']('ip -o addr show {0}'.format(options))
+    return _structured_addresses_output(output)
+
+def _ip_neighbours(options):
+    """
+    PRIVATE METHOD
+    Return neighbours by parsing the output of "ip -o neigh show"
+    """
+    output = __salt__['cmd.run']('ip -o neigh show {0}'.format(options))
+    return _structured_neigh_output(output)
+
+
+# rtnetlink, see linux/netlink.h, linux/rtnetlink.h, linux/if_link.h,
+# linux/if_addr.h and linux/neighbour.h
+NLMSG_HEADER = struct.Struct('=LHHLL')
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWLINK, RTM_GETLINK = 16, 18
+RTM_NEWADDR, RTM_GETADDR = 20, 22
+RTM_NEWNEIGH, RTM_GETNEIGH = 28, 30
+
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBI')
+NDMSG = struct.Struct('=BxxxiHBB')
+RTATTR = struct.Struct('=HH')
+
+IFLA_ADDRESS, IFLA_BROADCAST, IFLA_IFNAME, IFLA_MTU = 1, 2, 3, 4
+IFLA_QDISC, IFLA_MASTER, IFLA_TXQLEN = 6, 10, 13
+IFLA_OPERSTATE, IFLA_LINKMODE, IFLA_GROUP = 16, 17, 27
+IFA_ADDRESS, IFA_LOCAL, IFA_LABEL, IFA_BROADCAST, IFA_CACHEINFO = 1, 2, 3, 4, 6
+NDA_DST, NDA_LLADDR = 1, 2
+
+# same order as iproute2 prints them
+IFF_FLAGS = [
+    ('LOOPBACK', 0x8), ('BROADCAST', 0x2), ('POINTOPOINT', 0x10),
+    ('MULTICAST', 0x1000), ('NOARP', 0x80), ('ALLMULTI', 0x200),
+    ('PROMISC', 0x100), ('NOTRAILERS', 0x20), ('DEBUG', 0x4),
+    ('DYNAMIC', 0x8000), ('AUTOMEDIA', 0x4000), ('PORTSEL', 0x2000),
+    ('MASTER', 0x400), ('SLAVE', 0x800), ('UP', 0x1), ('LOWER_UP', 0x10000),
+    ('DORMANT', 0x20000), ('ECHO', 0x40000)]
+IFF_UP = 0x1
+IFF_RUNNING = 0x40
+
+ARPHRD_NAMES = {
+    1: 'ether', 24: 'ieee1394', 32: 'infiniband', 512: 'ppp', 768: 'ipip',
+    769: 'tunnel6', 772: 'loopback', 776: 'sit', 778: 'gre', 823: 'gre6',
+    65534: 'none'}
+OPERSTATES = ['UNKNOWN', 'NOTPRESENT', 'DOWN', 'LOWERLAYERDOWN', 'TESTING',
+              'DORMANT', 'UP']
+LINKMODES = ['DEFAULT', 'DORMANT']
+SCOPES = {0: 'global', 200: 'site', 253: 'link', 254: 'host', 255: 'nowhere'}
+NUD_STATES = [
+    ('INCOMPLETE', 0x01), ('REACHABLE', 0x02), ('STALE', 0x04),
+    ('DELAY', 0x08), ('PROBE', 0x10), ('FAILED', 0x20), ('NOARP', 0x40),
+    ('PERMANENT', 0x80)]
+NUD_NOARP = 0x40
+INFINITY_LIFE_TIME = 0xFFFFFFFF
+
+def _nl_dump(msg_type, payload):
+    """
+    PRIVATE METHOD
+    Send one rtnetlink dump request and return the (type, body) of every reply
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0)
+    try:
+        sock.bind((0, 0))
+        seq = int(time.time())
+        sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), msg_type,
+                                    NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + payload)
+        messages = []
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, reply_type, _, reply_seq, _ = \
+                    NLMSG_HEADER.unpack_from(data, offset)
+                if length < NLMSG_HEADER.size:
+                    return messages
+                body = data[offset + NLMSG_HEADER.size:offset + length]
+                offset += (length + 3) & ~3
+                if reply_seq != seq:
+                    continue
+                if reply_type == NLMSG_DONE:
+                    return messages
+                if reply_type == NLMSG_ERROR:
+                    errno = -struct.unpack_from('=i', body)[0]
+                    raise socket.error(errno, 'rtnetlink dump failed')
+                messages.append((reply_type, body))
+    finally:
+        sock.close()
+
+def _nl_attributes(data, offset):
+    """
+    PRIVATE METHOD
+    Return the rtattrs found in data from offset on as a {type: payload} dict
+    """
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type] = data[offset + RTATTR.size:offset + length]
+        offset += (length + 3) & ~3
+    return attrs
+
+def _nl_string(data):
+    """
+    PRIVATE METHOD
+    Decode a NUL terminated netlink string
+    """
+    return str(data.split(b'\0', 1)[0].decode('ascii'))
+
+def _nl_u32(data):
+    """
+    PRIVATE METHOD
+    Decode a native unsigned 32 bit netlink attribute
+    """
+    return struct.unpack('=I', data[:4])[0]
+
+def _nl_u8(data):
+    """
+    PRIVATE METHOD
+    Decode an unsigned 8 bit netlink attribute
+    """
+    return struct.unpack('=B', data[:1])[0]
+
+def _nl_lladdr(data):
+    """
+    PRIVATE METHOD
+    Format a link layer address like ip does, as colon separated hex bytes
+    """
+    return ':'.join('{0:02x}'.format(byte)
+                    for byte in struct.unpack('{0}B'.format(len(data)), data))
+
+def _nl_ipaddr(family, data):
+    """
+    PRIVATE METHOD
+    Format an IPv4 or IPv6 address attribute
+    """
+    return socket.inet_ntop(family, data)
+
+def _nl_links():
+    """
+    PRIVATE METHOD
+    Return all links from one RTM_GETLINK dump, keyed by interface index
+    """
+    res = {}
+    for msg_type, body in _nl_dump(RTM_GETLINK, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+        if msg_type != RTM_NEWLINK:
+            continue
+        _, link_type, index, flags, _ = IFINFOMSG.unpack_from(body)
+        attrs = _nl_attributes(body, IFINFOMSG.size)
+        if IFLA_IFNAME not in attrs:
+            continue
+        res[index] = (_nl_string(attrs[IFLA_IFNAME]), link_type, flags, attrs)
+    return res
+
+def _nl_link_infos(index, link_type, flags, attrs, names):
+    """
+    PRIVATE METHOD
+    Turn a RTM_NEWLINK message into the structure built from the ip output
+    """
+    flag_names = [name for name, bit in IFF_FLAGS if flags & bit]
+    if flags & IFF_UP and not flags & IFF_RUNNING:
+        flag_names.insert(0, 'NO-CARRIER')
+    settings = {}
+    if IFLA_MTU in attrs:
+        settings['mtu'] = _nl_u32(attrs[IFLA_MTU])
+    if IFLA_QDISC in attrs:
+        settings['qdisc'] = _nl_string(attrs[IFLA_QDISC])
+    if IFLA_MASTER in attrs:
+        master = _nl_u32(attrs[IFLA_MASTER])
+        settings['master'] = names.get(master, master)
+    if IFLA_OPERSTATE in attrs:
+        state = _nl_u8(attrs[IFLA_OPERSTATE])
+        settings['state'] = OPERSTATES[state] if state < len(OPERSTATES) else state
+    if IFLA_LINKMODE in attrs:
+        mode = _nl_u8(attrs[IFLA_LINKMODE])
+        settings['mode'] = LINKMODES[mode] if mode < len(LINKMODES) else mode
+    if IFLA_GROUP in attrs:
+        group = _nl_u32(attrs[IFLA_GROUP])
+        settings['group'] = 'default' if group == 0 else group
+    if IFLA_TXQLEN in attrs:
+        settings['qlen'] = _nl_u32(attrs[IFLA_TXQLEN])
+    infos = {
+        'num':   index,
+        'flags': flag_names,
+        'link':  ARPHRD_NAMES.get(link_type, '[{0}]'.format(link_type)),
+        'addr':  _nl_lladdr(attrs[IFLA_ADDRESS]),
+        'brd':   _nl_lladdr(attrs[IFLA_BROADCAST]),
+    }
+    if settings:
+        infos['settings'] = settings
+    return infos
+
+def _nl_structured_links():
+    """
+    PRIVATE METHOD
+    Return a dictionary mapping link names to link informations from netlink
+    """
+    dump = _nl_links()
+    names = dict((index, link[0]) for index, link in dump.items())
+    res = {}
+    for index, (name, link_type, flags, attrs) in dump.items():
+        # ip output without a link layer address is not matched either
+        if IFLA_ADDRESS in attrs and IFLA_BROADCAST in attrs:
+            res[name] = _nl_link_infos(index, link_type, flags, attrs, names)
+    return res
+
+def _nl_lifetime(seconds):
+    """
+    PRIVATE METHOD
+    Format an address lifetime like ip does
+    """
+    if seconds == INFINITY_LIFE_TIME:
+        return 'forever'
+    return '{0}sec'.format(seconds)
+
+def _nl_structured_addresses(dev=None, scope=None):
+    """
+    PRIVATE METHOD
+    Return a dictionary mapping link names to addresses from netlink
+    """
+    names = dict((index, link[0]) for index, link in _nl_links().items())
+    res = {}
+    for msg_type, body in _nl_dump(RTM_GETADDR, IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+        if msg_type != RTM_NEWADDR:
+            continue
+        family, prefixlen, _, addr_scope, index = IFADDRMSG.unpack_from(body)
+        if family not in (socket.AF_INET, socket.AF_INET6):
+            continue
+        name = names.get(index)
+        if name is None or (dev is not None and name != dev):
+            continue
+        scope_name = SCOPES.get(addr_scope, str(addr_scope))
+        if scope is not None and scope_name != scope:
+            continue
+        attrs = _nl_attributes(body, IFADDRMSG.size)
+        address = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+        if address is None:
+            continue
+        infos = {
+            'addr':  '{0}/{1}'.format(_nl_ipaddr(family, address), prefixlen),
+            'type':  'inet' if family == socket.AF_INET else 'inet6',
+            'scope': scope_name,
+        }
+        if IFA_BROADCAST in attrs:
+            infos['brd'] = _nl_ipaddr(family, attrs[IFA_BROADCAST])
+        if IFA_LABEL in attrs:
+            infos['alias'] = _nl_string(attrs[IFA_LABEL])
+        if IFA_CACHEINFO in attrs:
+            preferred, valid = struct.unpack('=II', attrs[IFA_CACHEINFO][:8])
+            infos['settings'] = {'valid_lft': _nl_lifetime(valid),
+                                 'preferred_lft': _nl_lifetime(preferred)}
+        res.setdefault(name, [])
+        res[name].append(infos)
+    return res
+
+def _nl_structured_neighbours(dev=None, nud=None):
+    """
+    PRIVATE METHOD
+    Return a dictionary mapping address and device to neighborhood information
+    from netlink. Like ip, NOARP entries are only listed when asked for.
+    """
+    names = dict((index, link[0]) for index, link in _nl_links().items())
+    res = {}
+    for msg_type, body in _nl_dump(RTM_GETNEIGH, NDMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+        if msg_type != RTM_NEWNEIGH:
+            continue
+        family, index, state, _, _ = NDMSG.unpack_from(body)
+        if family not in (socket.AF_INET, socket.AF_INET6):
+            continue
+        if nud is None:
+            if state & NUD_NOARP:
+                continue
+        elif nud != 'all' and not state & dict(NUD_STATES).get(nud.upper(), 0):
+            continue
+        name = names.get(index)
+        if name is None or (dev is not None and name != dev):
+            continue
+        attrs = _nl_attributes(body, NDMSG.size)
+        if NDA_DST not in attrs:
+            continue
+        infos = {}
+        if NDA_LLADDR in attrs:
+            infos['lladdr'] = _nl_lladdr(attrs[NDA_LLADDR])
+        states = [state_name for state_name, bit in NUD_STATES if state & bit]
+        if states:
+            infos['state'] = states[0]
+        res[(_nl_ipaddr(family, attrs[NDA_DST]), name)] = infos
+    return res
+
+def _nl_options(options, keys):
+    """
+    PRIVATE METHOD
+    Turn an "ip" option string into keyword arguments for the netlink backend,
+    or None if it uses options the netlink backend does not implement
+    """
+    words = options.split()
+    if len(words) % 2:
+        return None
+    kwargs = {}
+    for key, value in zip(words[::2], words[1::2]):
+        if key not in keys:
+            return None
+        kwargs[keys[key]] = value
+    return kwargs
+
+def _netlink(func, *args, **kwargs):
+    """
+    PRIVATE METHOD
+    Run a netlink backend function, returning None if netlink is unusable
+    so the caller can fall back to the ip command
+    """
+    if __opts__.get('netconfig.backend', 'netlink') != 'netlink':
+        return None
+    try:
+        return func(*args, **kwargs)
+    except (socket.error, struct.error, AttributeError) as exc:
+        log.debug('netconfig: netlink failed, falling back to ip: %s', exc)
+        return None
+
+def links():
+    """
+    Return information about all network links on the system
+    """
+    res = _netlink(_nl_structured_links)
+    if res is None:
+        res = _ip_links()
+    return res
+
 def link(name):
     """
     Return information about a given network link on the system
     """
+    res = _netlink(_nl_structured_links)
+    if res is not None:
+        if name in res:
+            return name, res[name]
+        return None
     output = __salt__['cmd.run']('ip -o link show {0}'.format(name))
     match = LINK_MATCHER.match(output)
     if match:
@@ -203,8 +553,13 @@ def addresses_with_options(options):
     Return information about addresses for a given "ip addr show" set of options
     eg netconfig.addresses_with_options 'scope host'
     """
-    output = __salt__['cmd.run']('ip -o addr show {0}'.format(options))
-    return _structured_addresses_output(output)
+    kwargs = _nl_options(options, {'dev': 'dev', 'scope': 'scope'})
+    res = None
+    if kwargs is not None:
+        res = _netlink(_nl_structured_addresses, **kwargs)
+    if res is None:
+        res = _ip_addresses(options)
+    return res
 
 def addresses():
     """
@@ -225,8 +580,13 @@ def neighbours_with_options(options):
     Return information about neighbours for a given "ip neigh show" set of options
     eg netconfig.neighbours_with_options 'nud noarp'
     """
-    output = __salt__['cmd.run']('ip -o neigh show {0}'.format(options))
-    return _structured_neigh_output(output)
+    kwargs = _nl_options(options, {'dev': 'dev', 'nud': 'nud'})
+    res = None
+    if kwargs is not None:
+        res = _netlink(_nl_structured_neighbours, **kwargs)
+    if res is None:
+        res = _ip_neighbours(options)
+    return res
 
 def neighbours():
     """
@@ -246,6 +606,38 @@ def all_neighbours():
     """
     return neighbours_with_options('nud all')
 
+def benchmark(iterations=10):
+    """
+    Time the netlink backend against the ip command on this host
+    Returns the mean milliseconds per call of both backends, the speedup and
+    whether both returned the same data, for links, addresses and neighbours
+    eg netconfig.benchmark 100
+    """
+    iterations = int(iterations)
+    cases = [
+        ('links', _nl_structured_links, _ip_links, ()),
+        ('addresses', _nl_structured_addresses, _ip_addresses, ('',)),
+        ('neighbours', _nl_structured_neighbours, _ip_neighbours, ('',)),
+    ]
+    res = {'iterations': iterations}
+    for name, nl_func, ip_func, ip_args in cases:
+        timings = {}
+        for backend, func, args in (('netlink', nl_func, ()), ('ip', ip_func, ip_args)):
+            start = time.time()
+            for _ in range(iterations):
+                output = func(*args)
+            timings[backend] = (time.time() - start) * 1000.0 / iterations
+            timings[backend + '_output'] = output
+        res[name] = {
+            'netlink_ms': round(timings['netlink'], 3),
+            'ip_ms': round(timings['ip'], 3),
+            'speedup': round(timings['ip'] / timings['netlink'], 1)
+                if timings['netlink'] else None,
+            'entries': len(timings['netlink_output']),
+            'identical': timings['netlink_output'] == timings['ip_output'],
+        }
+    return res
+
 # TODO: brctl show
 # TODO: ip maddr show
 # TODO: ifenslave -a (not sure how parseable this is)
@@ -1,31 +1,380 @@
 __virtualname__ = 'netconfig'
 
+import fnmatch
+import itertools
+import os
+import re
+import socket
+import struct
+import time
+
+NETSTAT_FILES = ['/proc/net/netstat', '/proc/net/snmp']
+SNMP6_FILE = '/proc/net/snmp6'
+SNMP6_MATCHER = re.compile(r'^(Ip6|Icmp6|Udp6|UdpLite6)(.+)$')
+
+# kernel socket states, include/net/tcp_states.h
+TCP_STATES = {
+    '01': 'ESTABLISHED', '02': 'SYN_SENT', '03': 'SYN_RECV',
+    '04': 'FIN_WAIT1', '05': 'FIN_WAIT2', '06': 'TIME_WAIT', '07': 'CLOSE',
+    '08': 'CLOSE_WAIT', '09': 'LAST_ACK', '0A': 'LISTEN', '0B': 'CLOSING',
+    '0C': 'NEW_SYN_RECV'}
+SOCKET_FILES = {'tcp': socket.AF_INET, 'tcp6': socket.AF_INET6,
+                'udp': socket.AF_INET, 'udp6': socket.AF_INET6}
+
 def __virtual__():
     """
     Only run on Linux systems
     """
     return 'netstat' if __grains__['kernel'] == 'Linux' else False
 
-def s():
+def _selection(counters):
+    """
+    PRIVATE METHOD
+    Turn "Prefix:Name" globs, as a list or a comma-separated string, into a
+    tuple of (prefix glob, name glob) pairs. A glob without a colon matches
+    counters of that name in any prefix.
+    """
+    if counters is None:
+        return None
+    if isinstance(counters, basestring):
+        counters = counters.split(',')
+    res = []
+    for counter in counters:
+        counter = counter.strip()
+        if not counter:
+            continue
+        if ':' in counter:
+            prefix, name = counter.split(':', 1)
+        else:
+            prefix, name = '*', counter
+        res.append((prefix, name))
+    return tuple(res)
+
+def _selected(selection, prefix, name):
+    """
+    PRIVATE METHOD
+    Tell whether a counter is part of the selection
+    """
+    if selection is None:
+        return True
+    for prefix_glob, name_glob in selection:
+        if fnmatch.fnmatchcase(prefix, prefix_glob) and \
+                fnmatch.fnmatchcase(name, name_glob):
+            return True
+    return False
+
+def _netns_root(netns):
+    """
+    PRIVATE METHOD
+    Return the /proc directory whose net/ files show the given network
+    namespace: a pid, a name from "ip netns" or None for our own namespace.
+    Named namespaces are matched to a process living in them by inode, the
+    pid found is remembered for the next calls.
+    """
+    if netns is None:
+        return '/proc'
+    netns = str(netns)
+    if netns.isdigit():
+        return '/proc/{0}'.format(netns)
+    inode = os.stat(os.path.join('/var/run/netns', netns)).st_ino
+    pids = __context__.setdefault('netstat.netns_pids', {})
+    pid = pids.get(netns)
+    candidates = [pid] if pid else []
+    candidates += [entry for entry in os.listdir('/proc') if entry.isdigit()]
+    for pid in candidates:
+        try:
+            if os.stat('/proc/{0}/ns/net'.format(pid)).st_ino == inode:
+                pids[netns] = pid
+                return '/proc/{0}'.format(pid)
+        except OSError:
+            continue
+    raise OSError('No process found in network namespace {0}'.format(netns))
+
+def _read(path):
+    """
+    PRIVATE METHOD
+    Return the lines of a proc file
+    """
+    with open(path) as handle:
+        return handle.read().splitlines()
+
+def _paired_layout(header_lines, selection):
+    """
+    PRIVATE METHOD
+    Return, for each header line, the prefix and the (column, name) pairs
+    of the selected counters
+    """
+    layout = []
+    for line in header_lines:
+        prefix, names = line.split(': ', 1)
+        columns = [(pos, name) for pos, name in enumerate(names.split(' '))
+                   if _selected(selection, prefix, name)]
+        layout.append((prefix, columns))
+    return layout
+
+def _read_paired(path, selection, stats):
+    """
+    PRIVATE METHOD
+    Read a file made of "Prefix: names" / "Prefix: values" line pairs, only
+    converting the selected columns. The column indexes are computed once
+    per header layout and selection and kept in __context__.
+    """
+    lines = _read(path)
+    header_lines = tuple(lines[0::2])
+    layouts = __context__.setdefault('netstat.layouts', {})
+    key = (header_lines, selection)
+    layout = layouts.get(key)
+    if layout is None:
+        layout = layouts[key] = _paired_layout(header_lines, selection)
+    for (prefix, columns), line in zip(layout, lines[1::2]):
+        if not columns:
+            continue
+        items = line.split(': ', 1)[1].split(' ')
+        counters = stats.setdefault(prefix, {})
+        for pos, name in columns:
+            counters[name] = int(items[pos])
+
+def _read_snmp6(path, selection, stats):
+    """
+    PRIVATE METHOD
+    Read the "Ip6InReceives value" lines of snmp6, splitting the names into
+    the same prefix and name as the other files
+    """
+    decisions = __context__.setdefault('netstat.snmp6', {})
+    for line in _read(path):
+        fields = line.split()
+        if len(fields) != 2:
+            continue
+        key = (fields[0], selection)
+        decision = decisions.get(key)
+        if decision is None:
+            match = SNMP6_MATCHER.match(fields[0])
+            decision = False
+            if match and _selected(selection, match.group(1), match.group(2)):
+                decision = match.groups()
+            decisions[key] = decision
+        if decision:
+            stats.setdefault(decision[0], {})[decision[1]] = int(fields[1])
+
+def _wants_snmp6(selection):
+    """
+    PRIVATE METHOD
+    Tell whether the selection can match any IPv6 counter
+    """
+    if selection is None:
+        return False
+    for prefix_glob, _ in selection:
+        for prefix in ('Ip6', 'Icmp6', 'Udp6', 'UdpLite6'):
+            if fnmatch.fnmatchcase(prefix, prefix_glob):
+                return True
+    return False
+
+def _rates(key, stats):
+    """
+    PRIVATE METHOD
+    Turn absolute counters into per-second rates against the previous sample
+    of the same selection kept in __context__. Returns an empty dict on the
+    first sample. A counter lower than before was reset and counts from zero.
+    """
+    now = time.time()
+    samples = __context__.setdefault('netstat.samples', {})
+    previous = samples.get(key)
+    samples[key] = (now, stats)
+    if previous is None or now <= previous[0]:
+        return {}
+    elapsed = now - previous[0]
+    rates = {}
+    for prefix, counters in stats.items():
+        before = previous[1].get(prefix, {})
+        for name, value in counters.items():
+            if name not in before:
+                continue
+            delta = value - before[name]
+            if delta < 0:
+                delta = value
+            rates.setdefault(prefix, {})[name] = round(delta / elapsed, 3)
+    return rates
+
+def s(counters=None, rate=False, netns=None):
     """
     Return the statistics available in netstat -s.
     The netstat command is not needed: we use kernel-provided files directly.
+
+    counters restricts the result to "Prefix:Name" globs, eg
+    "TcpExt:ListenOverflows,Tcp:RetransSegs,Ip6:In*"; only those columns
+    are parsed. IPv6 counters from snmp6 are read when the selection asks
+    for them.
+    rate returns per-second deltas since the previous call with the same
+    counters and netns instead of absolute values; the first call only
+    records a sample and returns an empty dict.
+    netns reads the statistics of another network namespace, given as a
+    name from "ip netns" or as the pid of a process inside it.
+
+    eg netstat.s counters='TcpExt:ListenOverflows,Tcp:RetransSegs' rate=True
     """
+    selection = _selection(counters)
+    root = _netns_root(netns)
     stats = {}
-    lines = open('/proc/net/netstat').readlines() + \
-            open('/proc/net/snmp').readlines()
-
-    currently_in_header_line = True
-    for line in lines:
-        sections = line.split(': ')
-        prefix, list = sections[0], sections[1].strip()
-        stats.setdefault(prefix, {})
-        items = list.split(' ')
-        if currently_in_header_line:
-            headers = items
-        else:
-            for pos in range(len(headers)):
-                stats[prefix][headers[pos]] = int(items[pos])
-        currently_in_header_line = not currently_in_header_line
+    for path in NETSTAT_FILES:
+        _read_paired(root + path[len('/proc'):], selection, stats)
+    if _wants_snmp6(selection) and os.path.exists(root + SNMP6_FILE[len('/proc'):]):
+        _read_snmp6(root + SNMP6_FILE[len('/proc'):], selection, stats)
 
+    if rate:
+        return _rates((selection, netns), stats)
     return stats
+
+def _list(value):
+    """
+    PRIVATE METHOD
+    Accept a single value, a comma-separated string or a list
+    """
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        return [item.strip() for item in value.split(',') if item.strip()]
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+def _socket_inodes(pids=None):
+    """
+    PRIVATE METHOD
+    Map socket inodes to the pid holding them with a single pass over the
+    host's /proc/<pid>/fd, restricted to the given pids if any. Processes
+    of every network namespace are listed there. Processes which vanish or
+    which we may not inspect are skipped.
+    """
+    if pids is None:
+        pids = [entry for entry in os.listdir('/proc') if entry.isdigit()]
+    owners = {}
+    for pid in pids:
+        fd_dir = '/proc/{0}/fd'.format(pid)
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(fd_dir + '/' + fd)
+            except OSError:
+                continue
+            if target.startswith('socket:['):
+                owners[target[8:-1]] = int(pid)
+    return owners
+
+def _hex_address(family, address):
+    """
+    PRIVATE METHOD
+    Decode a /proc/net address, stored as 32 bit words in host byte order
+    """
+    words = [int(address[pos:pos + 8], 16) for pos in range(0, len(address), 8)]
+    return socket.inet_ntop(family, struct.pack('={0}I'.format(len(words)), *words))
+
+def _iter_sockets(path, proto, states, ports, inodes, owners):
+    """
+    PRIVATE METHOD
+    Stream one /proc/net/{tcp,udp}[6] file, yielding a tuple per socket
+    which passes the filters. The filters compare the raw hex fields, so
+    addresses are only decoded for the sockets which are kept.
+    """
+    family = SOCKET_FILES[proto]
+    with open(path) as handle:
+        handle.readline()
+        for line in handle:
+            fields = line.split(None, 10)
+            if len(fields) < 10:
+                continue
+            state = fields[3]
+            if states is not None and state not in states:
+                continue
+            local, remote = fields[1], fields[2]
+            if ports is not None and local[-4:] not in ports \
+                    and remote[-4:] not in ports:
+                continue
+            inode = fields[9]
+            if inodes is not None and inode not in inodes:
+                continue
+            yield (proto,
+                   TCP_STATES.get(state, state),
+                   _hex_address(family, local[:-5]), int(local[-4:], 16),
+                   _hex_address(family, remote[:-5]), int(remote[-4:], 16),
+                   int(fields[7]), int(inode),
+                   owners.get(inode) if owners is not None else None)
+
+def _iter_connections(root, protos, states, ports, inodes, owners):
+    """
+    PRIVATE METHOD
+    Chain the sockets of every requested /proc/net file of root
+    """
+    for proto in protos:
+        path = '{0}/net/{1}'.format(root, proto)
+        if not os.path.exists(path):
+            continue
+        for sock in _iter_sockets(path, proto, states, ports, inodes, owners):
+            yield sock
+
+def connections(protos='tcp,tcp6,udp,udp6', state=None, port=None, pid=None,
+                processes=False, count_by=None, limit=None, netns=None):
+    """
+    Return the sockets of the system from /proc/net/{tcp,tcp6,udp,udp6},
+    like ss does, as a list of
+    (proto, state, local addr, local port, remote addr, remote port, uid, inode, pid)
+
+    state, port and pid filter the sockets while the files are read; each
+    takes a single value, a list or a comma-separated string. port matches
+    the local or the remote port. The pid column is only filled in when
+    processes is True or pid is given, as it needs a walk of /proc/*/fd.
+    count_by returns the number of matching sockets per value of one or
+    more of the columns instead of the sockets, which keeps the result small
+    on hosts with hundreds of thousands of sockets; the sockets are counted
+    as they are read and never held all at once. limit stops reading after
+    that many matching sockets.
+    netns selects the /proc/net files as for netstat.s; the pids are always
+    looked up in the host's /proc.
+
+    eg netstat.connections state=CLOSE_WAIT count_by=pid
+    """
+    root = _netns_root(netns)
+    columns = ['proto', 'state', 'local', 'lport', 'remote', 'rport', 'uid',
+               'inode', 'pid']
+
+    states = None
+    if state is not None:
+        codes = dict((name, code) for code, name in TCP_STATES.items())
+        states = set(codes.get(str(name).upper(), str(name).upper())
+                     for name in _list(state))
+    ports = None
+    if port is not None:
+        ports = set('{0:04X}'.format(int(number)) for number in _list(port))
+    group = _list(count_by)
+    if group is not None:
+        unknown = [column for column in group if column not in columns]
+        if unknown:
+            return {'Error': 'Unknown columns: {0}'.format(', '.join(unknown))}
+
+    protos = _list(protos)
+    unknown = [proto for proto in protos if proto not in SOCKET_FILES]
+    if unknown:
+        return {'Error': 'Unknown protocol: {0}'.format(', '.join(unknown))}
+
+    owners = None
+    inodes = None
+    if pid is not None:
+        owners = _socket_inodes([str(number) for number in _list(pid)])
+        inodes = owners
+    elif processes or (group is not None and 'pid' in group):
+        owners = _socket_inodes()
+
+    sockets = _iter_connections(root, protos, states, ports, inodes, owners)
+    if limit is not None:
+        sockets = itertools.islice(sockets, int(limit))
+    if group is None:
+        return list(sockets)
+
+    res = {}
+    positions = [columns.index(column) for column in group]
+    for sock in sockets:
+        key = ' '.join(str(sock[pos]) for pos in positions)
+        res[key] = res.get(key, 0) + 1
+    return res
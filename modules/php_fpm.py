@@ -3,8 +3,9 @@
 Get varyous php fpm statistic
 '''
 
+import glob
+import os
 import flup_fcgi_client as fcgi_client
-import salt.utils
 from os import listdir
 from ConfigParser import ConfigParser
 
@@ -17,6 +18,7 @@ def ping(baseConfigPath = None):
 
         salt '*' php_fpm.ping
         salt '*' php_fpm.ping baseConfigPath = '/etc/php5/fpm/pool.d/'
+        salt '*' php_fpm.ping baseConfigPath = '/etc/php5/fpm/php-fpm.conf'
     '''
 
     config = _detect_fpm_configuration(baseConfigPath)
@@ -51,6 +53,7 @@ def status(baseConfigPath=None):
 
         salt '*' php_fpm.status
         salt '*' php_fpm.status baseConfigPath = '/etc/php5/fpm/pool.d/'
+        salt '*' php_fpm.status baseConfigPath = '/etc/php5/fpm/php-fpm.conf'
     '''
     
     config = _detect_fpm_configuration(baseConfigPath)
@@ -69,26 +72,101 @@ def status(baseConfigPath=None):
                     result.append('Can not get PHP FPM status')    
     return "\n".join(result)
 
-@salt.utils.memoize
+# Per-file parse cache: path -> ((mtime, size), {section: [(key, value)]})
+_CONFIG_CACHE = {}
+
+
 def _detect_fpm_configuration(basePath):
-    """ try to read php fpm config """
-    configFiles = []
+    """ try to read php fpm config
 
+    basePath may be a pool directory (every ``*.conf`` in it is read) or a
+    main config file such as ``php-fpm.conf`` whose ``include=`` globs are
+    followed. Files are only re-parsed when their mtime or size changed, so
+    new or edited pools are picked up without a minion restart.
+    """
     if basePath is None:
         basePath = '/etc/php5/fpm/pool.d/'
-    
-    dirList= listdir(basePath)
-    for fname in dirList:
-        if fname[-5:] != '.conf':
-            continue
-        configFiles.append(basePath + fname)
+
+    if os.path.isdir(basePath):
+        configFiles = _list_pool_files(basePath)
+    else:
+        configFiles = _resolve_includes(basePath)
 
     config = ConfigParser()
-    config.read(configFiles)
-    
+    for fname in configFiles:
+        sections = _read_config_file(fname)
+        if sections is None:
+            continue
+        for section, items in sections.items():
+            if section == 'global':
+                continue
+            if not config.has_section(section):
+                config.add_section(section)
+            for key, value in items:
+                config.set(section, key, value)
+
+    # forget files which are gone from the listing
+    for fname in list(_CONFIG_CACHE):
+        if not os.path.exists(fname):
+            del _CONFIG_CACHE[fname]
+
     return config
 
 
+def _list_pool_files(basePath):
+    """ list the pool config files of a directory in a stable order """
+    configFiles = []
+    for fname in sorted(listdir(basePath)):
+        if fname[-5:] != '.conf':
+            continue
+        configFiles.append(os.path.join(basePath, fname))
+    return configFiles
+
+
+def _resolve_includes(mainPath):
+    """ expand a main config file and its include= globs into a file list """
+    configFiles = [mainPath]
+    sections = _read_config_file(mainPath)
+    if not sections:
+        return configFiles
+
+    baseDir = os.path.dirname(mainPath)
+    for items in sections.values():
+        for key, value in items:
+            if key != 'include':
+                continue
+            pattern = value.strip()
+            if not os.path.isabs(pattern):
+                pattern = os.path.join(baseDir, pattern)
+            for fname in sorted(glob.glob(pattern)):
+                if fname not in configFiles:
+                    configFiles.append(fname)
+    return configFiles
+
+
+def _read_config_file(fname):
+    """ parse one config file, reusing the cached result if unchanged """
+    try:
+        st = os.stat(fname)
+    except OSError:
+        _CONFIG_CACHE.pop(fname, None)
+        return None
+
+    stamp = (st.st_mtime, st.st_size)
+    cached = _CONFIG_CACHE.get(fname)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    parser = ConfigParser()
+    parser.read([fname])
+    sections = {}
+    for section in parser.sections():
+        sections[section] = [(key, parser.get(section, key, raw=True))
+                             for key in parser.options(section)]
+    _CONFIG_CACHE[fname] = (stamp, sections)
+    return sections
+
+
 def _make_fcgi_request(config, section, request_path):
     """ load fastcgi page """
     try:
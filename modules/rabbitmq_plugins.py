@@ -42,10 +42,32 @@ def _rabbitmq_plugins(command, runas=None, env=()):
     else:
         return False
 
-def list(runas=None, env=()):
+def _names(names):
+    '''
+    Accept a plugin name, a list of names or a comma separated string
+    '''
+    if isinstance(names, basestring):
+        names = names.replace(',', ' ').split()
+    return [name for name in names if name]
+
+def _invalidate():
+    '''
+    Forget the cached plugin listings after plugins were changed
+    '''
+    __context__.pop('rabbitmq_plugins.list', None)
+
+def list(runas=None, env=(), refresh=False):
     '''
     Return list of plugins: name, state and version
+
+    The listing boots an Erlang VM, so it is cached for the rest of the run
+    and refreshed after enable or disable, or when refresh is True.
     '''
+    cache = __context__.setdefault('rabbitmq_plugins.list', {})
+    key = repr((runas, env or ()))
+    if not refresh and key in cache:
+        return dict((name, dict(info)) for name, info in cache[key].items())
+
     regex = re.compile(
         r'^\[(?P<state>[a-zA-Z ])\] (?P<name>[^ ]+) +(?P<version>[^ ]+)$')
     plugins = {}
@@ -60,16 +82,31 @@ def list(runas=None, env=()):
                 }
         else:
             log.warning("line '%s' is invalid", line)
-    return plugins
+    cache[key] = plugins
+    return dict((name, dict(info)) for name, info in plugins.items())
 
 def enable(name, runas=None, env=()):
     '''
-    Turn on a rabbitmq plugin
+    Turn on one or more rabbitmq plugins, in a single rabbitmq-plugins call
+
+    name
+        A plugin name, a list of names or a comma separated string
     '''
-    return _rabbitmq_plugins('enable %s' % name, runas=runas, env=env)
+    names = _names(name)
+    if not names:
+        return True
+    _invalidate()
+    return _rabbitmq_plugins('enable %s' % ' '.join(names), runas=runas, env=env)
 
 def disable(name, runas=None, env=()):
     '''
-    Turn off a rabbitmq plugin
+    Turn off one or more rabbitmq plugins, in a single rabbitmq-plugins call
+
+    name
+        A plugin name, a list of names or a comma separated string
     '''
-    return _rabbitmq_plugins('disable %s' % name, runas=runas, env=env)
+    names = _names(name)
+    if not names:
+        return True
+    _invalidate()
+    return _rabbitmq_plugins('disable %s' % ' '.join(names), runas=runas, env=env)
@@ -1,13 +1,32 @@
 '''
 Support for riak
+
+Health and statistics are read from the node's HTTP interface, reusing one
+keep-alive connection, instead of booting an Erlang VM for riak-admin. The
+interface is expected at http://127.0.0.1:8098 unless configured otherwise::
+
+    riak.http_url: 'http://127.0.0.1:8098'
+
+Cluster changes still go through riak-admin.
 '''
 
+# Import python libs
+import httplib
+import json
+import re
+import socket
+import time
+import urlparse
+
 import salt.utils
 
 __outputter__ = {
     'signal': 'txt',
 }
 
+# Keep-alive connections to riak's HTTP interface, by (scheme, netloc)
+_CONNECTIONS = {}
+
 def __virtual__():
     '''
     Only load the module if riak is installed
@@ -18,6 +37,40 @@ def __virtual__():
     return False
 
 
+def _http_get(path, timeout=5):
+    '''
+    GET a path from the node's HTTP interface and return the status code
+    and body. The connection is kept open for the next request and opened
+    again once if the server dropped it in the meantime.
+    '''
+    url = __salt__['config.option']('riak.http_url') or 'http://127.0.0.1:8098'
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    for attempt in (1, 2):
+        conn = _CONNECTIONS.get(key)
+        if conn is None:
+            if parts.scheme == 'https':
+                conn = httplib.HTTPSConnection(parts.netloc, timeout=timeout)
+            else:
+                conn = httplib.HTTPConnection(parts.netloc, timeout=timeout)
+            _CONNECTIONS[key] = conn
+        try:
+            conn.request('GET', parts.path.rstrip('/') + path,
+                         headers={'Connection': 'keep-alive'})
+            response = conn.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            _CONNECTIONS.pop(key, None)
+            if attempt == 2:
+                raise
+            continue
+        if response.getheader('connection', '').lower() == 'close':
+            conn.close()
+            _CONNECTIONS.pop(key, None)
+        return response.status, body
+
+
 def version():
     '''
     Return Riak node version
@@ -49,12 +102,11 @@ def is_up():
 
         salt '*' riak.is_up
     '''
-    cmd = 'riak ping'
-    out = __salt__['cmd.run'](cmd).split('\n')
-    if out[-1] == "pong":
-        return True
-    else:
+    try:
+        code, body = _http_get('/ping')
+    except (httplib.HTTPException, socket.error):
         return False
+    return code == 200 and body.strip() == 'OK'
 
 
 def start():
@@ -66,6 +118,7 @@ def start():
         salt '*' riak.start
     '''
     cmd = 'riak start'
+    _admin_invalidate()
     out = __salt__['cmd.run'](cmd).split('\n')
     msgs = [line for line in out if not line.startswith("!!!!")]
     if len(msgs) > 0 and msgs[0].startswith("Attempting"):
@@ -86,6 +139,7 @@ def stop():
         salt '*' riak.stop
     '''
     cmd = 'riak stop'
+    _admin_invalidate()
     out = __salt__['cmd.run'](cmd).split('\n')
     msgs = [line for line in out if not line.startswith("!!!!")]
     if len(msgs) > 0 and msgs[0].startswith("Attempting"):
@@ -106,6 +160,7 @@ def restart():
         salt '*' riak.restart
     '''
     cmd = 'riak restart'
+    _admin_invalidate()
     out = __salt__['cmd.run'](cmd).split('\n')
     msgs = [line for line in out if not line.startswith("!!!!")]
     if len(msgs) > 0 and msgs[0].startswith("Attempting"):
@@ -130,6 +185,7 @@ def cluster_join(node):
     if len(node.split("@")) != 2:
         return False
     cmd = 'riak-admin cluster join %s' % node
+    _admin_invalidate()
     out = __salt__['cmd.run'](cmd).split('\n')
     msgs = [line for line in out if not line.startswith("!!!!")]
     if len(msgs) > 0 and msgs[0].startswith("Attempting"):
@@ -166,6 +222,7 @@ def cluster_leave(node=None, force=False):
         cmd = 'riak-admin cluster force-remove'
     if node is not None:
         cmd = '%s %s' % (cmd, node)
+    _admin_invalidate()
     out = __salt__['cmd.run'](cmd).split('\n')
     msgs = [line for line in out if not line.startswith("!!!!")]
     if len(msgs) > 0 and msgs[0].startswith("Attempting"):
@@ -199,6 +256,7 @@ def cluster_replace(node1, node2, force=False):
     if len(node1.split("@")) != 2 and len(node2.split("@")) != 2:
         return False
     cmd = 'riak-admin cluster replace %s %s' % (node1, node2)
+    _admin_invalidate()
     out = __salt__['cmd.run'](cmd).split('\n')
     msgs = [line for line in out if not line.startswith("!!!!")]
     if len(msgs) > 0 and msgs[0].startswith("Attempting"):
@@ -237,6 +295,7 @@ def cluster_clear():
         salt '*' riak.cluster_clear
     '''
     cmd = 'riak-admin cluster clear'
+    _admin_invalidate()
     out = __salt__['cmd.run'](cmd).split('\n')
     msgs = [line for line in out if not line.startswith("!!!!")]
     if len(msgs) > 0 and msgs[0].startswith("Attempting"):
@@ -256,6 +315,7 @@ def cluster_commit():
         salt '*' riak.cluster_commit
     '''
     cmd = 'riak-admin cluster commit'
+    _admin_invalidate()
     out = __salt__['cmd.run'](cmd).split('\n')
     msgs = [line for line in out if not line.startswith("!!!!")]
     if len(msgs) > 0 and msgs[0].startswith("Attempting"):
@@ -274,30 +334,96 @@ def ringready():
 
         salt '*' riak.ringready
     '''
-    cmd = 'riak-admin ringready'
-    out = __salt__['cmd.run'](cmd).split('\n')
+    out = _admin('ringready')
     if len(out) > 0 and out[0].startswith("TRUE"):
         return True
     else:
         return False
 
 
+def _admin(subcommand):
+    '''
+    Run a read-only riak-admin subcommand and return its output lines.
+
+    Output is cached in __context__ for riak.admin_cache_ttl seconds (5 by
+    default), so several calls in one job share a single riak-admin run.
+    Cluster changes made through this module drop the cache.
+    '''
+    cache = __context__.setdefault('riak.admin', {})
+    ttl = __salt__['config.option']('riak.admin_cache_ttl')
+    if ttl is None or ttl == '':
+        ttl = 5
+    ttl = float(ttl)
+    cached = cache.get(subcommand)
+    if cached is not None and time.time() - cached[0] < ttl:
+        return cached[1]
+    out = __salt__['cmd.run']('riak-admin {0}'.format(subcommand)).split('\n')
+    cache[subcommand] = (time.time(), out)
+    return out
+
+
+def _admin_invalidate():
+    __context__.pop('riak.admin', None)
+
+
+def _node(text):
+    return text.strip().strip("'")
+
+
+def _percent(text):
+    match = re.search(r'(\d+(?:\.\d+)?)%\s*$', text)
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+def _node_list(text):
+    return [_node(node) for node in text.strip().strip('[]').split(',') if node.strip()]
+
+
 def ring_status():
     '''
     Outputs the current claimant, its status, ringready, pending ownership 
     handoffs and a list of unreachable nodes.
 
+    Pending handoffs are listed per partition index with their owner, next
+    owner and the vnode types still waited on and already complete.
+
     CLI Example::
 
         salt '*' riak.ring_status
     '''
-    cmd = 'riak-admin ring-status'
-    out = __salt__['cmd.run'](cmd).split('\n')
-    out = out[1:len(out)]
-    ret = []
-    for line in out:
-        if len(line) > 0 and line[:1] != "=" and line[:1] != " ":
-            ret.append(line)
+    ret = {'claimant': None, 'status': None, 'ringready': None,
+           'handoffs': [], 'unreachable': []}
+    handoff = None
+    owners = {}
+    for line in _admin('ring-status'):
+        line = line.strip()
+        if not line or line.startswith('='):
+            continue
+        key, sep, value = line.partition(':')
+        key = key.strip().lower()
+        if not sep:
+            continue
+        if key == 'claimant':
+            ret['claimant'] = _node(value)
+        elif key == 'status':
+            ret['status'] = value.strip()
+        elif key == 'ring ready':
+            ret['ringready'] = value.strip() == 'true'
+        elif key == 'owner':
+            owners = {'owner': _node(value)}
+        elif key == 'next owner':
+            owners['next_owner'] = _node(value)
+        elif key == 'index':
+            handoff = dict(owners, index=value.strip(), waiting=[], complete=[])
+            ret['handoffs'].append(handoff)
+        elif key == 'waiting on' and handoff is not None:
+            handoff['waiting'] = _node_list(value)
+        elif key == 'complete' and handoff is not None:
+            handoff['complete'] = _node_list(value)
+        elif key == 'the following nodes are unreachable':
+            ret['unreachable'] = _node_list(value)
     return ret
 
 
@@ -305,17 +431,28 @@ def member_status():
     '''
     Prints the current status of all cluster members.
 
+    Returns each member's status with its current and pending share of the
+    ring in percent (None while no change is pending), and the number of
+    members per status.
+
     CLI Example::
 
         salt '*' riak.member_status
     '''
-    cmd = 'riak-admin member-status'
-    out = __salt__['cmd.run'](cmd).split('\n')
-    out = out[1:len(out)]
-    ret = []
-    for line in out:
-        if len(line) > 0 and line[:1] != "=" and line[:1] != "-":
-            ret.append(line)
+    ret = {'members': {}, 'summary': {}}
+    for line in _admin('member-status'):
+        fields = line.split()
+        if len(fields) == 4 and fields[3].startswith("'"):
+            ret['members'][_node(fields[3])] = {
+                'status': fields[0],
+                'ring': _percent(fields[1]),
+                'pending': _percent(fields[2]),
+            }
+        elif line.startswith('Valid:'):
+            for item in line.split('/'):
+                name, sep, count = item.partition(':')
+                if sep:
+                    ret['summary'][name.strip().lower()] = int(count)
     return ret
 
 
@@ -323,16 +460,49 @@ def transfers():
     '''
     Identifies nodes that are awaiting transfer of one or more partitions.
 
+    Returns the number of partitions each node is waiting to hand off, the
+    primary partitions not running per node, and the active transfers.
+
     CLI Example::
 
         salt '*' riak.transfers
     '''
-    cmd = 'riak-admin transfers'
-    out = __salt__['cmd.run'](cmd).split('\n')
-    if out[0] == "No transfers active":
-        return out[0]
-    else:
-        return out
+    ret = {'waiting': {}, 'down': {}, 'active': []}
+    transfer = None
+    for line in _admin('transfers'):
+        line = line.strip()
+        match = re.match(r"'([^']+)' waiting to handoff (\d+) partitions", line)
+        if match:
+            ret['waiting'][match.group(1)] = int(match.group(2))
+            continue
+        match = re.match(r"'([^']+)' does not have (\d+) primary partitions running", line)
+        if match:
+            ret['down'][match.group(1)] = int(match.group(2))
+            continue
+        key, sep, value = line.partition(': ')
+        key = key.strip().lower()
+        if key == 'transfer type':
+            transfer = {'type': value.strip()}
+            ret['active'].append(transfer)
+        elif transfer is None:
+            continue
+        elif key == 'vnode type':
+            transfer['vnode'] = value.strip()
+        elif key == 'partition':
+            transfer['partition'] = value.strip()
+        elif key == 'objects transferred':
+            transfer['objects'] = int(value.strip().replace(',', ''))
+        elif key in ('started', 'last update', 'total size'):
+            transfer[key.replace(' ', '_')] = value.strip()
+        else:
+            match = re.match(r"'([^']+)'\s+=*>?\s*'([^']+)'", line)
+            if match:
+                transfer['source'] = match.group(1)
+                transfer['target'] = match.group(2)
+            elif line.endswith('%'):
+                transfer['percent'] = _percent(line)
+    ret['pending'] = sum(ret['waiting'].values())
+    return ret
 
 
 def diag():
@@ -356,15 +526,17 @@ def status():
     Prints status information, including performance statistics, system health
     information, and version numbers.
 
+    The statistics come from the node's /stats HTTP resource as a dict of
+    numbers, strings and lists.
+
     CLI Example::
 
         salt '*' riak.status
     '''
-    cmd = 'riak-admin status'
-    out = __salt__['cmd.run'](cmd).split('\n')
-    ret = []
-    for line in out:
-        parts = line.split(" : ")
-        if len(parts) == 2:
-            ret.append({parts[0]: parts[1]})
-    return ret
+    try:
+        code, body = _http_get('/stats')
+    except (httplib.HTTPException, socket.error) as exc:
+        return {'Error': 'Riak HTTP interface unavailable: {0}'.format(exc)}
+    if code != 200:
+        return {'Error': 'Riak /stats returned HTTP {0}'.format(code)}
+    return json.loads(body)
@@ -12,6 +12,17 @@ smx.user: admin user name
 smx.pass: password
 smx.path: /absolute/path/to/servicemix/home
 
+The console is reached over its SSH port, one connection is kept and reused
+for all commands (host and port default to localhost and 8101, and can be
+set as smx:host / smx:port grains or smx.host / smx.port pillar). This needs
+paramiko; without it, or when the SSH port cannot be reached, every command
+runs through bin/client instead.
+
+The console host key must be in the system known_hosts of the minion user,
+unknown keys are rejected. Set smx:auto_add_host_key / smx.auto_add_host_key
+to True to accept the key on first connection instead. smx:timeout /
+smx.timeout sets the connection and read timeout in seconds (default 60).
+
 Note:
 - if both pillar & grains settings exists -> grains wins
 - Tested on apache-servicemix-full-4.4.2.tar.gz
@@ -20,271 +31,591 @@ Note:
 '''
 
 # libs
+import logging
+import re
 import time
 
+try:
+    import paramiko
+    HAS_PARAMIKO = True
+except ImportError:
+    HAS_PARAMIKO = False
+
+log = logging.getLogger(__name__)
+
+# console commands after which the cached tables are out of date
+_MUTATING = ('features:install', 'features:uninstall', 'features:addurl',
+             'features:removeurl', 'features:refreshurl', 'osgi:start',
+             'osgi:stop', 'osgi:install', 'osgi:uninstall', 'osgi:update',
+             'osgi:refresh')
+
+_ANSI = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+_BRACKETS = re.compile(r'\[\s*([^\]]*?)\s*\]')
+
+
 def __virtual__():
     '''
     Load the module by default
     '''
-    
+
     return 'smx'
 
-def _parse_list(list=[]):
+
+class _ConsoleSession(object):
     '''
-    Used to parse the result off the list commands.
-    for example:
-     run('osgi:list')
-     run('features:list')
+    One SSH connection to the Karaf console. Every command runs on its own
+    channel of that connection, so several commands can be sent before the
+    first answer is read.
     '''
-    ret = []
-    for line in list:
-        line = line.replace(']','')
-        line = line.replace('[','')
-        ret.append(line)
-    
+
+    def __init__(self, host, port, user, password, timeout, auto_add=False):
+        self.timeout = timeout
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        # the console listens with a key generated on first start, only
+        # trust it blindly when asked to
+        if auto_add:
+            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        else:
+            self.client.set_missing_host_key_policy(paramiko.RejectPolicy())
+        self.client.connect(host, port=port, username=user, password=password,
+                            timeout=timeout, look_for_keys=False,
+                            allow_agent=False)
+
+    def active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def run_many(self, cmds):
+        transport = self.client.get_transport()
+        channels = []
+        for cmd in cmds:
+            channel = transport.open_session()
+            channel.settimeout(self.timeout)
+            channel.exec_command(cmd)
+            channels.append(channel)
+        ret = []
+        for channel in channels:
+            chunks = []
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+            channel.close()
+            ret.append(_ANSI.sub('', ''.join(chunks)).splitlines())
+        return ret
+
+    def close(self):
+        self.client.close()
+
+
+def _settings():
+    '''
+    Console settings from the grains, or from modules.config.option
+    '''
+    grains = __grains__.get('smx', {})
+    ret = {}
+    for key, default in (('user', None), ('pass', None), ('path', None),
+                         ('host', 'localhost'), ('port', 8101), ('timeout', 60),
+                         ('auto_add_host_key', False)):
+        if key in grains:
+            ret[key] = grains[key]
+        else:
+            try:
+                ret[key] = __salt__['config.option']('smx.{0}'.format(key)) or default
+            except Exception:
+                ret[key] = default
+    return ret
+
+
+def _session(settings):
+    '''
+    Return the console session of this job, connecting on first use
+    '''
+    session = __context__.get('smx.session')
+    if session is not None and session.active():
+        return session
+    if session is not None:
+        session.close()
+    __context__.pop('smx.session', None)
+    if not HAS_PARAMIKO or not settings['user'] or not settings['pass']:
+        return None
+    try:
+        session = _ConsoleSession(settings['host'], int(settings['port']),
+                                  settings['user'], settings['pass'],
+                                  float(settings['timeout']),
+                                  str(settings['auto_add_host_key']).lower()
+                                  in ('true', 'yes', '1'))
+    except Exception as exc:
+        log.warning('smx: cannot open console session, using bin/client: {0}'.format(exc))
+        return None
+    __context__['smx.session'] = session
+    return session
+
+
+def _client_run(settings, cmd):
+    '''
+    Run one command through bin/client, starting a new JVM
+    '''
+    if not (settings['user'] and settings['pass'] and settings['path']):
+        return []
+    bin = settings['path'] + '/bin/client'
+    ret = __salt__['cmd.run']( "'{0}' -u '{1}' -p '{2}' '{3}'".format(bin, settings['user'], settings['pass'], cmd) ).splitlines()
+    if len(ret) > 0 and ret[0].startswith('client: JAVA_HOME not set'):
+        ret.pop(0)
     return ret
 
+
+def run_many(cmds):
+    '''
+    execute several commands in the servicemix console, sending them all
+    before reading the answers, will return an array of the STDOUT lines
+    of each command
+
+    CLI Examples::
+
+        salt '*' smx.run_many '[features:listurl, osgi:list]'
+    '''
+    if any(cmd.split(' ', 1)[0] in _MUTATING for cmd in cmds):
+        __context__.pop('smx.tables', None)
+
+    settings = _settings()
+    session = _session(settings)
+    if session is not None:
+        try:
+            return session.run_many(cmds)
+        except Exception as exc:
+            log.warning('smx: console session failed, using bin/client: {0}'.format(exc))
+            session.close()
+            __context__.pop('smx.session', None)
+    return [_client_run(settings, cmd) for cmd in cmds]
+
+
 def run(cmd='shell:logout'):
     '''
     execute a command in the servicemix console
     will return an array of the STDOUT
-    
+
     CLI Examples::
-        
+
         salt '*' smx.run 'osgi:list'
     '''
-    
-    # Get command from grains, if are not set default to modules.config.option
-    try:
-        user = __grains__['smx']['user']
-        password = __grains__['smx']['pass']
-        bin = __grains__['smx']['path'] + '/bin/client'
-    except KeyError:
-        try:
-            user = __salt__['config.option']('smx.user')
-            password = __salt__['config.option']('smx.pass')
-            bin = __salt__['config.option']('smx.path')
-            if user and password and bin:
-                bin += '/bin/client'
-            else:
-                return []
-        except Exception:
-            return []
-    
-    ret = __salt__['cmd.run']( "'{0}' -u '{1}' -p '{2}' '{3}'".format(bin, user, password, cmd) ).splitlines()
-    if len(ret) > 0 and ret[0].startswith('client: JAVA_HOME not set'):
-        ret.pop(0)
+
+    return run_many([cmd])[0]
+
+
+def _parse_table(lines):
+    '''
+    Parse a console listing into a list of rows, each a list of columns.
+    Handles the "[col] [col] rest" listings of Karaf 2 as well as the
+    "col | col | col" tables of later versions. Header lines are dropped.
+    '''
+    rows = []
+    for line in lines:
+        if '|' in line:
+            columns = [column.strip() for column in line.split('|')]
+            if set(line.strip()) <= set('-+|'):
+                continue
+            rows.append(columns)
+            continue
+        columns = []
+        rest = line
+        while True:
+            match = _BRACKETS.match(rest.lstrip())
+            if not match:
+                break
+            columns.append(match.group(1))
+            rest = rest.lstrip()[match.end():]
+        if columns:
+            rows.append(columns + rest.split())
+    return rows
+
+
+def _table(name, refresh=False):
+    '''
+    Return one of the parsed console tables, cached until a console command
+    changes them
+    '''
+    tables = __context__.setdefault('smx.tables', {})
+    if refresh or name not in tables:
+        tables[name] = _PARSERS[name](run(_COMMANDS[name]))
+    return tables[name]
+
+
+def _parse_features(lines):
+    ret = []
+    pipe = any('|' in line for line in lines)
+    header = None
+    for columns in _parse_table(lines):
+        if pipe:
+            if header is None:
+                header = [column.lower() for column in columns]
+                continue
+            row = dict(zip(header, columns))
+            ret.append({'name': row.get('name', ''),
+                        'version': row.get('version', ''),
+                        'state': 'installed' if row.get('state', '').lower() in
+                                 ('started', 'installed', 'resolved') or
+                                 row.get('installed', '').lower() == 'x'
+                                 else 'uninstalled',
+                        'repository': row.get('repository', '')})
+        elif len(columns) >= 3:
+            ret.append({'state': columns[0],
+                        'version': columns[1],
+                        'name': columns[2],
+                        'repository': columns[3] if len(columns) > 3 else ''})
+    return ret
+
+
+def _parse_bundles(lines):
+    ret = {}
+    pipe = any('|' in line for line in lines)
+    header = None
+    for columns in _parse_table(lines):
+        if pipe:
+            if header is None:
+                header = [column.lower() for column in columns]
+                continue
+            row = dict(zip(header, columns))
+            name = row.get('symbolic name', row.get('name', ''))
+            ret[name] = {'id': row.get('id', ''), 'state': row.get('state', ''),
+                         'level': row.get('lvl', '')}
+        elif len(columns) >= 3 and columns[0].isdigit():
+            # [id] [state] [blueprint] [spring] [level] name ..., the last
+            # column is the name used by the functions below
+            ret[columns[-1]] = {'id': columns[0], 'state': columns[1],
+                                'level': columns[4] if len(columns) > 5 else ''}
+    return ret
+
+
+def _parse_repos(lines):
+    ret = []
+    for line in lines:
+        fields = [field.strip() for field in line.split('|')] if '|' in line else line.split()
+        if len(fields) < 2 or fields[0] in ('Loaded', 'Repository') or \
+                set(line.strip()) <= set('-+|'):
+            continue
+        ret.append(fields[-1])
     return ret
 
+
+_COMMANDS = {
+    'features': 'features:list',
+    'bundles': 'osgi:list -s -u',
+    'repos': 'features:listurl',
+}
+
+_PARSERS = {
+    'features': _parse_features,
+    'bundles': _parse_bundles,
+    'repos': _parse_repos,
+}
+
+
+def features(installed=False, refresh=False):
+    '''
+    Return the features known to servicemix as a list of dicts with name,
+    version, state and repository
+
+    CLI Examples::
+
+        salt '*' smx.features
+        salt '*' smx.features installed=True
+    '''
+    ret = _table('features', refresh)
+    if installed:
+        ret = [feature for feature in ret if feature['state'] == 'installed']
+    return ret
+
+
+def bundles(refresh=False):
+    '''
+    Return the bundles as a dict of name to id, state and start level
+    (names in the format of osgi:list -s -u)
+
+    CLI Examples::
+
+        salt '*' smx.bundles
+    '''
+    return _table('bundles', refresh)
+
+
+def repos(refresh=False):
+    '''
+    Return the configured feature repository URLs
+
+    CLI Examples::
+
+        salt '*' smx.repos
+    '''
+    return _table('repos', refresh)
+
+
 def status():
     '''
     Test if the servicemix daemon is running
-    
+
     CLI Examples::
-        
+
         salt '*' smx.status
     '''
-    return run('osgi:list | head -n 1 | grep -c ^START') == ['1']
+    lines = run(_COMMANDS['bundles'])
+    if not lines or not lines[0].startswith('START'):
+        return False
+    __context__.setdefault('smx.tables', {})['bundles'] = _parse_bundles(lines)
+    return True
+
 
 def is_repo(url):
     '''
     check if the URL is configured as a feature repository
-    
+
     CLI Examples::
-        
+
         salt '*' smx.is_repo http://salt/smxrepo/repo.xml
     '''
-    
-    return run('features:listurl | grep -c " {0}$"'.format(url)) == ['1']
+
+    return url in repos()
+
 
 def feature_addurl(url):
     '''
     Add the url as a feature repository
-    
+
     CLI Examples::
-        
+
         salt '*' smx.features_addurl http://salt/smxrepo/repo.xml
     '''
-    
+
     if is_repo(url):
         return 'present'
-    
+
     run('features:addurl {0}'.format(url))
     if is_repo(url):
         return 'new'
     else:
         return 'missing'
 
+
 def feature_removeurl(url):
     '''
     Remove the url as a feature repository
-    
+
     CLI Examples::
-        
+
         salt '*' smx.feature_removeurl http://salt/smxrepo/repo.xml
     '''
-        
+
     if is_repo(url) == False:
-        return 'absent'.format(url)
+        return 'absent'
     else:
         run('features:removeurl {0}'.format(url))
         if is_repo(url) == False:
-            return 'removed'.format(url)
+            return 'removed'
         else:
-            return 'failed'.format(url)
+            return 'failed'
+
 
 def feature_refreshurls():
     '''
-    Refresh all the feature repositories
-    
+    Refresh all the feature repositories, sending all the refresh commands
+    at once
+
     CLI Examples::
-        
+
         salt '*' smx.feature_refreshurls
     '''
-    
-    for line in run('features:listurl | grep -v "^ Loaded"'):
-        url = line.split()[1]
-        if feature_refreshurl(url) != 'refreshed':
+
+    urls = repos(refresh=True)
+    outputs = run_many(['features:refreshurl {0}'.format(url) for url in urls])
+    for url, out in zip(urls, outputs):
+        if any('Error' in line or 'Exception' in line for line in out):
             return 'error refreshing {0}'.format(url)
     return 'refreshed'
 
+
 def feature_refreshurl(url):
     '''
     Refresh the feature repository
-    
+
     CLI Examples::
-        
+
         salt '*' smx.feature_refreshurl http://salt/smxrepo/repo.xml
     '''
     if is_repo(url):
         run('features:refreshurl {0}'.format(url))
         return 'refreshed'
     else:
-        return 'missing'.format(url)
+        return 'missing'
+
 
 def bundle_active(bundle):
     '''
     check if the bundle is active
-    
+
     CLI Examples::
-        
+
         salt '*' smx.bundle_active 'some.bundle.name'
     '''
-    
-    for line in _parse_list(run('osgi:list -s -u | grep Active')):
-        lst = line.split()
-        if bundle == lst[-1]:
-             return True
-    
-    return False
+
+    return bundles().get(bundle, {}).get('state') == 'Active'
+
 
 def nonactive_bundles(bundles=''):
     '''
     return a list of non-active bundles from the csv list
-    
+
     CLI Examples::
-        
+
         salt '*' smx.nonactive_bundles 'some.bundle.name,some.other.name'
     '''
-    
-    ret = []
-    for b in bundles.split(','):
-        if bundle_active(b) == False:
-            ret.append(b)
+
+    table = _table('bundles')
+    ret = [b for b in bundles.split(',')
+           if b and table.get(b, {}).get('state') != 'Active']
     return ','.join(ret)
 
+
 def bundle_exists(bundle):
     '''
     check if the bundle exists
-    
+
     CLI Examples::
-        
+
         salt '*' smx.bundle_exists 'some.bundle.name'
     '''
-    
-    for line in _parse_list(run('osgi:list -s -u')):
-        lst = line.split()
-        if bundle == lst[-1]:
-             return True
-    
-    return False
+
+    return bundle in bundles()
+
 
 def bundle_start(bundle):
     '''
     start the bundle
-    
+
     CLI Examples::
-        
+
         salt '*' smx.bundle_start 'some.bundle.name'
     '''
-    
+
     if bundle_exists(bundle) == False:
         return 'missing'
-    
+
     run('osgi:start {0}'.format(bundle))
-    
+
     if bundle_active(bundle):
         return 'active'
     else:
         return 'error'
 
+
 def bundle_stop(bundle):
     '''
     stop the bundle
-    
+
     CLI Examples::
-        
+
         salt '*' smx.bundle_stop 'some.bundle.name'
     '''
-    
+
     if bundle_exists(bundle) == False:
         return 'missing'
-    
+
     run('osgi:stop {0}'.format(bundle))
-    
+
     if bundle_active(bundle) == False:
         return 'stopped'
     else:
         return 'error'
 
+
 def is_feature_installed(feature, version=''):
     '''
     check if the feature is installed
-    
+
     CLI Examples::
-        
+
         salt '*' smx.is_feature_installed 'myFeature'
         salt '*' smx.is_feature_installed 'myFeature' '1.1.0'
     '''
-    
-    for line in _parse_list(run('features:list -i')):
-        lst = line.split()
-        if version:
-            if version == lst[1] and feature == lst[2]:
-                return True
-        else:
-             if feature == lst[2]:
-                 return True
-    
+
+    for entry in features(installed=True):
+        if entry['name'] == feature and (not version or entry['version'] == version):
+            return True
+
     return False
 
+
+def latest_feature_version(feature):
+    '''
+    return the latest version of the feature found in the refreshed
+    repositories, or an empty string
+
+    CLI Examples::
+
+        salt '*' smx.latest_feature_version 'myFeature'
+    '''
+
+    feature_refreshurls()
+    latest = ''
+    for entry in features():
+        if entry['name'] == feature:
+            latest = max(entry['version'], latest)
+
+    return latest
+
+
 def is_feature_installed_latest(feature):
     '''
     check if the feature is installed
-    
+
     CLI Examples::
-        
+
         salt '*' smx.is_feature_installed_latest 'myFeature'
     '''
-    
-    latest = '0'
-    feature_refreshurls()
-    for line in _parse_list(run('features:list')):
-        lst = line.split()
-        if lst[2] == feature:
-            latest = max(str(lst[1]),latest)
-    
-    return is_feature_installed(feature, str(latest))
+
+    return is_feature_installed(feature, latest_feature_version(feature) or '0')
+
+
+def wait_for_bundles(bundles, timeout=60, interval=0.5, max_interval=5):
+    '''
+    Wait until all the bundles from the csv list are Active, fetching the
+    whole bundle table once per poll. The pause between polls starts at
+    interval and doubles up to max_interval while no bundle comes up, but
+    never runs past the deadline where a last poll is made.
+    Returns the csv list of the bundles still not Active at the deadline,
+    an empty string once they all are.
+
+    CLI Examples::
+
+        salt '*' smx.wait_for_bundles 'some.bundle.name,some.other.name' 120
+    '''
+
+    names = [b for b in bundles.split(',') if b]
+    deadline = time.time() + float(timeout)
+    pause = float(interval)
+    last = None
+    while True:
+        table = _table('bundles', refresh=True)
+        pending = [b for b in names if table.get(b, {}).get('state') != 'Active']
+        if not pending:
+            return ''
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            log.warning('smx: bundles not Active after {0}s: {1}'.format(
+                timeout, ','.join(pending)))
+            return ','.join(pending)
+        if last is not None:
+            if len(pending) < last:
+                pause = float(interval)
+            else:
+                pause = min(pause * 2, float(max_interval))
+        last = len(pending)
+        # never sleep past the deadline, the last poll happens right at it
+        sleep = min(pause, remaining)
+        log.debug('smx: waiting {0}s for bundles {1}'.format(sleep, ','.join(pending)))
+        time.sleep(sleep)
+
 
 def feature_install(feature, version='', bundles='', wait4bundles=5):
     '''
@@ -293,7 +624,8 @@ def feature_install(feature, version='', bundles='', wait4bundles=5):
     a third optional arguments is a csv list of bundle names
       that should be in Active mode after the feature installation to validate
       (in the format of osgi:list -s command)
-    a forth argument is a time in seconds to check the bundles if active
+    a forth argument is the time in seconds to wait at most for the bundles
+      to become Active, see wait_for_bundles
     
     CLI Examples::
         
@@ -313,14 +645,12 @@ def feature_install(feature, version='', bundles='', wait4bundles=5):
         if is_feature_installed(feature, version) == False:
             return 'failed'
     
-    if bundles != '':
-        time.sleep(wait4bundles)
-    errBundles = nonactive_bundles(bundles)
+    errBundles = wait_for_bundles(bundles, wait4bundles) if bundles else ''
     
     if len(errBundles) == 0:
         return 'installed'
     else:
-        return 'failed, non Active bundles: {0}'.format(','.join(errBundles))
+        return 'failed, non Active bundles: {0}'.format(errBundles)
     
 def feature_remove(feature, version=''):
     '''
@@ -356,12 +686,12 @@ def feature_remove_all_versions(feature):
     '''
     
     removed = ""
-    for line in _parse_list(run('features:list -i')):
-        lst = line.split()
-        if lst[0] == 'installed' and lst[2] == feature:
-            removed += " {0}".format(lst[1])
-            if feature_remove(feature, lst[1]) == 'error':
-                return 'error removing {0}'.format('/'.join([feature, lst[1]]))
+    versions = [entry['version'] for entry in features(installed=True)
+                if entry['name'] == feature]
+    for version in versions:
+        removed += " {0}".format(version)
+        if feature_remove(feature, version) == 'error':
+            return 'error removing {0}'.format('/'.join([feature, version]))
     
     if removed:
         return 'removed: {0}'.format(removed)
@@ -5,7 +5,13 @@ It measures various system parameters such as
 CPU, Memory, FileI/O, Threads and Mutex.
 '''
 
+import itertools
+import json
+import math
+import os
 import re
+import time
+import uuid
 import salt.utils
 
 __outputter__ = {
@@ -14,9 +20,47 @@ __outputter__ = {
     'threads': 'yaml',
     'mutex': 'yaml',
     'memory': 'yaml',
-    'fileio': 'yaml'
+    'fileio': 'yaml',
+    'suite': 'yaml'
 }
 
+# Parameter matrices used by suite() when none is given, the same
+# values the fixed tests below use
+DEFAULT_MATRICES = {
+    'cpu': {'cpu-max-prime': [500, 1000, 2500, 5000]},
+    'threads': {'num-threads': [64],
+                'thread-yields': [100, 200, 500, 1000],
+                'thread-locks': [2, 4, 8, 16]},
+    'mutex': {'num-threads': [250],
+              'mutex-num': [50, 500, 1000],
+              'mutex-locks': [10000, 25000, 50000],
+              'mutex-loops': [2500, 5000, 10000]},
+    'memory': {'num-threads': [64],
+               'memory-oper': ['read', 'write'],
+               'memory-scope': ['local', 'global'],
+               'memory-block-size': ['1K'],
+               'memory-total-size': ['32G']},
+    'fileio': {'num-threads': [16],
+               'file-num': [32],
+               'file-total-size': ['1G'],
+               'file-test-mode': ['seqwr', 'seqrewr', 'seqrd', 'rndrd',
+                                  'rndwr', 'rndrw']},
+}
+
+# metric name, regex, unit the value is given in when it has no suffix
+_METRICS = [
+    ('total_time_ms', re.compile(r'total time:\s*([\d.]+)[ \t]*(ms|s)?'), 's'),
+    ('events', re.compile(r'total number of events:\s*([\d.]+)()'), None),
+    ('events_per_s', re.compile(r'events per second:\s*([\d.]+)()'), None),
+    ('execution_time_ms', re.compile(r'(?:total time taken by event execution|'
+                                     r'event execution)[^:]*:\s*([\d.]+)[ \t]*(ms|s)?'),
+     's'),
+    ('latency_min_ms', re.compile(r'\bmin:\s*([\d.]+)[ \t]*(ms|s)?'), 'ms'),
+    ('latency_avg_ms', re.compile(r'\bavg:\s*([\d.]+)[ \t]*(ms|s)?'), 'ms'),
+    ('latency_max_ms', re.compile(r'\bmax:\s*([\d.]+)[ \t]*(ms|s)?'), 'ms'),
+    ('latency_p95_ms', re.compile(r'95(?:th)? percentile:\s*([\d.]+)[ \t]*(ms|s)?'), 'ms'),
+]
+
 
 def __virtual__():
     '''
@@ -62,6 +106,106 @@ def _parser(result):
            }
 
 
+def _parse_metrics(result):
+    '''
+    parses the output of sysbench 0.4 or 1.0 into floats, times in ms
+    '''
+    metrics = {}
+    for name, regex, default_unit in _METRICS:
+        match = regex.search(result)
+        if match is None:
+            continue
+        value = float(match.group(1))
+        unit = match.group(2) or default_unit
+        if unit == 's':
+            value *= 1000.0
+        metrics[name] = value
+    if 'events_per_s' not in metrics and metrics.get('total_time_ms') \
+            and 'events' in metrics:
+        metrics['events_per_s'] = metrics['events'] * 1000.0 / metrics['total_time_ms']
+    return metrics
+
+
+def _percentile(values, percent):
+    '''
+    percentile of sorted values, interpolating between the closest ranks
+    '''
+    if len(values) == 1:
+        return values[0]
+    rank = (len(values) - 1) * percent / 100.0
+    low = int(math.floor(rank))
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def _summary(samples):
+    '''
+    median, p95, stddev, mean, min and max of every metric over the samples
+    '''
+    summary = {}
+    names = set()
+    for sample in samples:
+        names.update(sample)
+    for name in names:
+        values = sorted(sample[name] for sample in samples if name in sample)
+        mean = sum(values) / len(values)
+        if len(values) > 1:
+            stddev = math.sqrt(sum((value - mean) ** 2 for value in values)
+                               / (len(values) - 1))
+        else:
+            stddev = 0.0
+        summary[name] = {
+            'median': _percentile(values, 50),
+            'p95': _percentile(values, 95),
+            'stddev': stddev,
+            'mean': mean,
+            'min': values[0],
+            'max': values[-1],
+            'count': len(values),
+        }
+    return summary
+
+
+def _matrix(matrix):
+    '''
+    expands {'option': [values]} into one dict per combination
+    '''
+    keys = sorted(matrix)
+    values = [matrix[key] if isinstance(matrix[key], (list, tuple))
+              else [matrix[key]] for key in keys]
+    return [dict(zip(keys, combination))
+            for combination in itertools.product(*values)]
+
+
+def _command(test, params, phase):
+    '''
+    builds the sysbench command line for one combination of parameters
+    '''
+    options = ' '.join('--{0}={1}'.format(key, params[key])
+                       for key in sorted(params))
+    return 'sysbench --test={0} {1} {2}'.format(test, options, phase)
+
+
+def _results_file():
+    '''
+    path of the NDJSON file the suite results are appended to
+    '''
+    return os.path.join(__opts__['cachedir'], 'sysbench', 'results.ndjson')
+
+
+def _save(records):
+    '''
+    appends the records to the results file, one JSON document per line
+    '''
+    path = _results_file()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'a') as fd_:
+        for record in records:
+            fd_.write(json.dumps(record, sort_keys=True) + '\n')
+    return path
+
+
 def cpu():
     '''
     Tests for the cpu performance of minions.
@@ -239,6 +383,84 @@ def fileio():
     return ret_val
 
 
+def suite(test, matrix=None, options=None, warmup=1, repetitions=3, save=True):
+    '''
+    Runs a sysbench test over a matrix of parameters and returns numeric
+    results with statistics, instead of the fixed tests above.
+
+    test
+        cpu, threads, mutex, memory or fileio
+    matrix
+        dict of sysbench options to lists of values, every combination is
+        run. Defaults to the values of the fixed test.
+    options
+        dict of sysbench options used for every combination
+    warmup
+        runs per combination which are thrown away
+    repetitions
+        measured runs per combination
+    save
+        append the results to <cachedir>/sysbench/results.ndjson
+
+    Every combination gets the raw samples and, per metric, the median,
+    p95, stddev, mean, min and max. Times are floats in ms, throughput in
+    events/s. The combinations are run one after the other so they do not
+    compete for the host; use num-threads in the matrix to measure
+    parallel load.
+
+    CLI Examples::
+
+        salt \* sysbench.suite cpu
+        salt \* sysbench.suite cpu matrix='{cpu-max-prime: [10000, 20000], num-threads: [1, 4]}' repetitions=5
+    '''
+    if test not in DEFAULT_MATRICES:
+        return {'Error': 'Unknown test {0}, use one of {1}'.format(
+            test, ', '.join(sorted(DEFAULT_MATRICES)))}
+    if matrix is None:
+        matrix = DEFAULT_MATRICES[test]
+    warmup = int(warmup)
+    repetitions = max(1, int(repetitions))
+
+    run_id = uuid.uuid4().hex
+    started = time.time()
+    results = []
+    for combination in _matrix(matrix):
+        params = dict(options or {}, **combination)
+        samples = []
+        errors = []
+        if test == 'fileio':
+            __salt__['cmd.run'](_command(test, params, 'prepare'))
+        for attempt in range(warmup + repetitions):
+            out = __salt__['cmd.run_all'](_command(test, params, 'run'))
+            if out['retcode']:
+                errors.append(out['stderr'] or out['stdout'])
+                continue
+            if attempt >= warmup:
+                samples.append(_parse_metrics(out['stdout']))
+        if test == 'fileio':
+            __salt__['cmd.run'](_command(test, params, 'cleanup'))
+        result = {'params': params,
+                  'samples': samples,
+                  'summary': _summary(samples) if samples else {}}
+        if errors:
+            result['errors'] = errors
+        results.append(result)
+
+    ret = {'run_id': run_id,
+           'test': test,
+           'started': started,
+           'duration_s': time.time() - started,
+           'warmup': warmup,
+           'repetitions': repetitions,
+           'results': results}
+    if save:
+        records = [dict(result, run_id=run_id, test=test, started=started,
+                        minion=__opts__['id'])
+                   for result in results]
+        ret['file'] = _save(records)
+    return ret
+
+
 def ping():
 
     return True
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+'''
+Orchestrate riak cluster changes across minions
+
+Joins a batch of new nodes, plans and commits the change once, then waits
+for the ownership changes and handoffs to finish while polling all members
+at the same time.
+'''
+# Import python libs
+import logging
+import time
+
+# Import salt libs
+import salt.client
+
+log = logging.getLogger(__name__)
+
+
+def _minion_list(minions):
+    if isinstance(minions, basestring):
+        minions = [minion.strip() for minion in minions.split(',')]
+    return [minion for minion in minions if minion]
+
+
+def _poll(client, members, timeout):
+    '''
+    Ask every member for transfers, ringready, member_status and ring_status
+    in one concurrent call.
+
+    The ring is only settled once no member reports pending ownership or
+    pending handoffs: right after a commit the transfer counters are still
+    zero although the ownership changes have not started yet.
+    '''
+    returns = client.cmd(members, ['riak.transfers', 'riak.ringready',
+                                   'riak.member_status', 'riak.ring_status'],
+                         [[], [], [], []], timeout=timeout, expr_form='list')
+    pending = 0
+    active = 0
+    ready = len(returns) == len(members)
+    settled = ready
+    for minion in members:
+        ret = returns.get(minion)
+        if not isinstance(ret, dict):
+            ready = False
+            continue
+        transfers = ret.get('riak.transfers')
+        if isinstance(transfers, dict):
+            # every member reports the cluster wide numbers; trust the worst
+            pending = max(pending, transfers.get('pending', 0))
+            active = max(active, len(transfers.get('active', [])))
+        else:
+            ready = False
+        if ret.get('riak.ringready') is not True:
+            ready = False
+        status = ret.get('riak.member_status')
+        ring = ret.get('riak.ring_status')
+        if not isinstance(status, dict) or not isinstance(ring, dict):
+            settled = False
+            continue
+        for member in status.get('members', {}).values():
+            if member.get('pending') is not None:
+                settled = False
+        if ring.get('handoffs'):
+            settled = False
+    return pending, active, ready and settled
+
+
+def join(minions, seed, claimant=None, timeout=3600, interval=5,
+         max_interval=60, cmd_timeout=60):
+    '''
+    Join the riak nodes on ``minions`` to the cluster of ``seed``, commit a
+    single plan for all of them and wait until the ring has settled
+
+    minions
+        Minion ids of the new nodes, as a list or comma separated string
+    seed
+        Riak node name of an existing member, e.g. ``riak@10.0.0.1``
+    claimant
+        Minion id used to plan and commit, the first of ``minions`` by
+        default
+    timeout
+        Seconds to wait in total for handoffs to finish
+    interval, max_interval
+        First and largest pause between polls; the pause doubles while
+        nothing changes and drops back to ``interval`` on progress
+
+    The ring counts as settled once ringready is true, no transfers are
+    left and neither member_status nor ring_status report any pending
+    ownership change.
+
+    Returns the join results, the committed plan and the handoff progress
+    as a list of (seconds elapsed, pending partitions) samples with an ETA.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run riak.join riak4,riak5,riak6 riak@10.0.0.1
+    '''
+    minions = _minion_list(minions)
+    if not minions:
+        return {'result': False, 'comment': 'No minions given'}
+    claimant = claimant or minions[0]
+    members = list(minions)
+    if claimant not in members:
+        members.append(claimant)
+    client = salt.client.LocalClient(__opts__['conf_file'])
+    ret = {'result': False, 'joined': {}, 'plan': None, 'commit': None,
+           'progress': [], 'eta': None}
+
+    # Stage all joins at once, the new nodes run them concurrently
+    joined = client.cmd(minions, 'riak.cluster_join', [seed],
+                        timeout=cmd_timeout, expr_form='list')
+    ret['joined'] = dict((minion, joined.get(minion, 'No response'))
+                         for minion in minions)
+    failed = [minion for minion, res in ret['joined'].items() if res is not True]
+    if failed:
+        ret['comment'] = 'Join failed on {0}'.format(', '.join(sorted(failed)))
+        return ret
+
+    ret['plan'] = client.cmd(claimant, 'riak.cluster_plan',
+                             timeout=cmd_timeout).get(claimant)
+    if not isinstance(ret['plan'], list):
+        ret['comment'] = 'No plan to commit on {0}: {1}'.format(claimant,
+                                                                ret['plan'])
+        return ret
+    ret['commit'] = client.cmd(claimant, 'riak.cluster_commit',
+                               timeout=cmd_timeout).get(claimant)
+    if not isinstance(ret['commit'], basestring) or \
+            not ret['commit'].startswith('Cluster changes committed'):
+        ret['comment'] = 'Commit failed on {0}: {1}'.format(claimant,
+                                                            ret['commit'])
+        return ret
+
+    # Wait for the handoffs with exponential backoff
+    start = time.time()
+    deadline = start + timeout
+    initial = None
+    last = None
+    pause = interval
+    while True:
+        pending, active, ready = _poll(client, members, cmd_timeout)
+        elapsed = round(time.time() - start, 1)
+        ret['progress'].append((elapsed, pending))
+        if initial is None:
+            initial = pending
+        done = initial - pending
+        if done > 0 and elapsed > 0:
+            ret['eta'] = round(pending * elapsed / done, 1)
+        log.info('riak handoff: %s partitions pending, %s active transfers, '
+                 'eta %s s', pending, active, ret['eta'])
+
+        if ready and pending == 0 and active == 0:
+            ret['result'] = True
+            ret['comment'] = 'Ring settled after {0} seconds'.format(elapsed)
+            return ret
+        if last is not None:
+            if pending < last:
+                pause = interval
+            else:
+                pause = min(pause * 2, max_interval)
+        last = pending
+        if time.time() + pause > deadline:
+            ret['comment'] = ('Gave up after {0} seconds with {1} partitions '
+                              'pending').format(elapsed, pending)
+            return ret
+        time.sleep(pause)
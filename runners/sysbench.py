@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+'''
+Run sysbench suites across the fleet and compare the results
+
+Minions sharing a hypervisor are benchmarked in separate waves so they do
+not skew each other, the results are then grouped per hardware class to
+get percentiles and to spot the minions which stand out.
+'''
+# Import python libs
+import logging
+import math
+
+# Import salt libs
+import salt.client
+
+log = logging.getLogger(__name__)
+
+
+def _waves(minions, grains, group_grain, per_group, wave_size):
+    '''
+    Split the minions into waves holding at most per_group minions with the
+    same value of group_grain. Minions without the grain count as their
+    own group.
+    '''
+    groups = {}
+    for minion in sorted(minions):
+        group = grains.get(minion, {}).get(group_grain) or minion
+        groups.setdefault(str(group), []).append(minion)
+    queues = [groups[group] for group in sorted(groups)]
+    waves = []
+    while any(queues):
+        wave = []
+        for queue in queues:
+            take = per_group
+            if wave_size:
+                take = min(take, wave_size - len(wave))
+            wave.extend(queue[:take])
+            del queue[:take]
+        waves.append(wave)
+    return waves
+
+
+def _percentile(values, percent):
+    '''
+    Percentile of sorted values, interpolating between the closest ranks
+    '''
+    if len(values) == 1:
+        return values[0]
+    rank = (len(values) - 1) * percent / 100.0
+    low = int(math.floor(rank))
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def _params_key(params):
+    return ' '.join('{0}={1}'.format(key, params[key]) for key in sorted(params))
+
+
+def _analyse(samples, threshold):
+    '''
+    Percentiles of one hardware class and combination, plus the minions
+    whose robust z-score (based on the median absolute deviation) is above
+    threshold
+    '''
+    values = sorted(value for _, value in samples)
+    median = _percentile(values, 50)
+    mad = _percentile(sorted(abs(value - median) for value in values), 50)
+    stats = {
+        'count': len(values),
+        'min': values[0],
+        'p5': _percentile(values, 5),
+        'p50': median,
+        'p95': _percentile(values, 95),
+        'max': values[-1],
+        'mad': mad,
+    }
+    outliers = []
+    if mad:
+        for minion, value in samples:
+            score = 0.6745 * (value - median) / mad
+            if abs(score) > threshold:
+                outliers.append({'minion': minion, 'value': value,
+                                 'score': round(score, 2)})
+    return stats, outliers
+
+
+def fleet(tgt, test, matrix=None, options=None, warmup=1, repetitions=3,
+          expr_form='glob', group_grain='hypervisor', per_group=1,
+          wave_size=None, class_grain='cpu_model', metric='events_per_s',
+          threshold=3.5, timeout=3600):
+    '''
+    Run ``sysbench.suite`` on the targeted minions in waves and aggregate
+    the results per hardware class
+
+    tgt, expr_form
+        Minions to benchmark
+    test, matrix, options, warmup, repetitions
+        Passed to ``sysbench.suite`` on every minion
+    group_grain
+        Grain naming the hypervisor (or any shared resource) of a minion
+    per_group
+        Maximum number of minions of the same group in one wave
+    wave_size
+        Maximum number of minions in one wave, unlimited by default
+    class_grain
+        Grain grouping comparable hardware
+    metric
+        Metric of the suite used for the comparison; each minion
+        contributes the median of its repetitions
+    threshold
+        Robust z-score above which a minion is reported as an outlier
+    timeout
+        Seconds to wait for one wave
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run sysbench.fleet 'db*' cpu per_group=2 class_grain=productname
+    '''
+    if int(per_group) < 1:
+        return {'result': False, 'comment': 'per_group must be at least 1'}
+    if wave_size and int(wave_size) < 1:
+        return {'result': False, 'comment': 'wave_size must be at least 1'}
+    client = salt.client.LocalClient(__opts__['conf_file'])
+    returns = client.cmd(tgt, 'grains.item', [group_grain, class_grain],
+                         expr_form=expr_form, timeout=60)
+    if not returns:
+        return {'result': False, 'comment': 'No minions matched {0}'.format(tgt)}
+    # minions which could not even return their grains are not benchmarked
+    grains = dict((minion, items) for minion, items in returns.items()
+                  if isinstance(items, dict))
+    failed = dict((minion, items) for minion, items in returns.items()
+                  if not isinstance(items, dict))
+
+    waves = _waves(grains, grains, group_grain, int(per_group),
+                   int(wave_size) if wave_size else None)
+    kwarg = {'matrix': matrix, 'options': options, 'warmup': warmup,
+             'repetitions': repetitions}
+    ret = {'result': True, 'waves': waves, 'classes': {}, 'outliers': {},
+           'failed': failed}
+
+    # class -> combination -> [(minion, value)]
+    collected = {}
+    for number, wave in enumerate(waves, 1):
+        log.info('sysbench wave %s/%s: %s', number, len(waves), ', '.join(wave))
+        returns = client.cmd(wave, 'sysbench.suite', [test], timeout=timeout,
+                             expr_form='list', kwarg=kwarg)
+        for minion in wave:
+            suite = returns.get(minion)
+            if not isinstance(suite, dict) or 'results' not in suite:
+                ret['failed'][minion] = suite if suite is not None else 'No response'
+                continue
+            hw_class = str(grains[minion].get(class_grain) or 'unknown')
+            for result in suite['results']:
+                summary = result.get('summary', {}).get(metric)
+                if summary is None:
+                    ret['failed'].setdefault(minion, result.get('errors', 'No samples'))
+                    continue
+                combination = _params_key(result['params'])
+                collected.setdefault(hw_class, {}).setdefault(combination, []).append(
+                    (minion, summary['median']))
+
+    for hw_class, combinations in collected.items():
+        for combination, samples in combinations.items():
+            stats, outliers = _analyse(samples, float(threshold))
+            ret['classes'].setdefault(hw_class, {})[combination] = stats
+            if outliers:
+                ret['outliers'].setdefault(hw_class, {})[combination] = outliers
+
+    if ret['failed']:
+        ret['result'] = False
+    return ret
@@ -0,0 +1,268 @@
+'''
+Bulk management of Keystone tenants, users and role grants.
+===========================================================
+
+NOTE: This module requires the proper pillar values set. See
+salt.modules.keystone for more information.
+
+The keystone state reconciles a whole set of tenants, users and
+(user, tenant, role) grants in one state. The current state is read with one
+listing per collection plus one concurrent role lookup per managed
+(user, tenant) pair, the differences are computed in memory and only the
+needed changes are sent, through a bounded pool of worker threads.
+
+.. code-block:: yaml
+
+    cloud accounts:
+      keystone.synced:
+        - tenants:
+          - admin
+          - name: demo
+            description: Demo tenant
+        - users:
+          - name: admin
+            password: verybadpass
+            email: admin@example.com
+            tenant: admin
+        - grants:
+          - [admin, admin, admin]
+          - [admin, demo, Member]
+        - workers: 8
+'''
+
+from multiprocessing.pool import ThreadPool
+
+
+def __virtual__():
+    '''
+    Only load if the keystone module is in __salt__
+    '''
+    return 'keystone' if 'keystone.user_create' in __salt__ else False
+
+
+def _pool_map(func, args, workers):
+    '''
+    Run func over args with at most workers threads, returning the results
+    in order. Exceptions are returned instead of raised so one failed call
+    does not hide the outcome of the others.
+    '''
+    def call(arg):
+        try:
+            return func(*arg)
+        except Exception as exc:  # pylint: disable=W0703
+            return exc
+    if not args:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(args))))
+    try:
+        return pool.map(call, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _failed(result):
+    return isinstance(result, Exception) or \
+        (isinstance(result, dict) and 'Error' in result)
+
+
+def _normalize(tenants, users, grants):
+    tenant_defs = []
+    for tenant in tenants or []:
+        if not isinstance(tenant, dict):
+            tenant = {'name': tenant}
+        tenant_defs.append(dict({'description': None, 'enabled': True}, **tenant))
+    user_defs = []
+    for user in users or []:
+        user_defs.append(dict({'tenant': None}, **user))
+    grant_defs = []
+    for grant in grants or []:
+        if isinstance(grant, dict):
+            grant = (grant['user'], grant['tenant'], grant['role'])
+        grant_defs.append(tuple(grant))
+    return tenant_defs, user_defs, grant_defs
+
+
+def _current_roles(pairs, users, tenants, workers):
+    '''
+    Fetch the roles of every (user, tenant) pair which already exists
+    '''
+    lookups = [(user, tenant) for user, tenant in pairs
+               if user in users and tenant in tenants]
+    current = dict((pair, set()) for pair in lookups)
+    if not lookups:
+        return current
+    table = __salt__['keystone.role_assignments'](pairs=lookups,
+                                                  workers=workers)
+    for user, tenant, role in zip(table['user'], table['tenant'], table['role']):
+        current[(user, tenant)].add(role)
+    return current
+
+
+def _plan(tenant_defs, user_defs, grant_defs, tenants, users, roles, current, prune):
+    plan = {'tenants': [], 'users': [], 'user_updates': [], 'roles': [],
+            'grants': [], 'revokes': []}
+
+    for tenant in tenant_defs:
+        if tenant['name'] not in tenants:
+            plan['tenants'].append(tenant)
+
+    for user in user_defs:
+        existing = users.get(user['name'])
+        if existing is None:
+            plan['users'].append(user)
+        elif any(existing[field] != user[field]
+                 for field in ('email', 'enabled') if field in user):
+            plan['user_updates'].append(user)
+
+    wanted = {}
+    for user, tenant, role in grant_defs:
+        wanted.setdefault((user, tenant), set()).add(role)
+        if role not in roles and role not in plan['roles']:
+            plan['roles'].append(role)
+    for pair in sorted(wanted):
+        have = current.get(pair, set())
+        for role in sorted(wanted[pair] - have):
+            plan['grants'].append(pair + (role,))
+        if prune:
+            for role in sorted(have - wanted[pair]):
+                plan['revokes'].append(pair + (role,))
+    return plan
+
+
+def _describe(plan):
+    changes = {}
+    if plan['tenants']:
+        changes['tenants_created'] = [t['name'] for t in plan['tenants']]
+    if plan['roles']:
+        changes['roles_created'] = plan['roles']
+    if plan['users']:
+        changes['users_created'] = [u['name'] for u in plan['users']]
+    if plan['user_updates']:
+        changes['users_updated'] = [u['name'] for u in plan['user_updates']]
+    if plan['grants']:
+        changes['grants_added'] = [list(g) for g in plan['grants']]
+    if plan['revokes']:
+        changes['grants_removed'] = [list(g) for g in plan['revokes']]
+    return changes
+
+
+def synced(name, tenants=None, users=None, grants=None, prune=False, workers=8):
+    '''
+    Ensure a whole set of tenants, users and role grants is present
+
+    name
+        An arbitrary name for this set
+    tenants
+        Tenant names, or dicts with name, description and enabled
+    users
+        Dicts with name, password, email, tenant and enabled. The password
+        is only used when the user is created.
+    grants
+        [user, tenant, role] triples; missing roles are created
+    prune
+        Also remove roles which a managed (user, tenant) pair has but
+        which are not listed in grants
+    workers
+        Maximum number of concurrent keystone requests
+    '''
+    ret = {
+            'name': name,
+            'changes': {},
+            'result': True,
+            'comment': ''
+            }
+    tenant_defs, user_defs, grant_defs = _normalize(tenants, users, grants)
+
+    #Snapshot the current state: one listing per collection
+    current_tenants = __salt__['keystone.tenant_list']()
+    current_users = __salt__['keystone.user_list']()
+    current_roles = __salt__['keystone.role_list']()
+    pairs = sorted(set((user, tenant) for user, tenant, role in grant_defs))
+    current = _current_roles(pairs, current_users, current_tenants, workers)
+
+    plan = _plan(tenant_defs, user_defs, grant_defs, current_tenants,
+                 current_users, current_roles, current, prune)
+    changes = _describe(plan)
+    if not changes:
+        ret['comment'] = 'Keystone set {0} is already in sync'.format(name)
+        return ret
+    if __opts__['test']:
+        ret['result'] = None
+        ret['changes'] = changes
+        ret['comment'] = 'Keystone set {0} is set to be synced'.format(name)
+        return ret
+
+    # only the mutations whose call succeeded are reported as changes
+    errors = []
+    done = dict((key, []) for key in plan)
+
+    def collect(key, names, results, label):
+        for item, item_name, result in zip(plan[key], names, results):
+            if _failed(result):
+                errors.append('{0} {1}: {2}'.format(label, item_name, result))
+            else:
+                done[key].append(item)
+
+    #Tenants and roles first, users and grants refer to them by id
+    results = _pool_map(
+            lambda t: __salt__['keystone.tenant_create'](
+                    t['name'], t['description'], t['enabled']),
+            [(t,) for t in plan['tenants']], workers)
+    collect('tenants', [t['name'] for t in plan['tenants']], results, 'tenant')
+    for result in results:
+        if not _failed(result):
+            current_tenants.update(result)
+    results = _pool_map(__salt__['keystone.role_create'],
+                        [(r,) for r in plan['roles']], workers)
+    collect('roles', plan['roles'], results, 'role')
+    for result in results:
+        if not _failed(result):
+            current_roles.update(result)
+
+    def create_user(user):
+        tenant = current_tenants.get(user['tenant'], {})
+        return __salt__['keystone.user_create'](
+                user['name'], user['password'], user.get('email'),
+                tenant_id=tenant.get('id'), enabled=user.get('enabled', True))
+
+    def update_user(user):
+        existing = current_users[user['name']]
+        return __salt__['keystone.user_update'](
+                id=existing['id'], name=user['name'],
+                email=user.get('email', existing['email']),
+                enabled=user.get('enabled', existing['enabled']))
+
+    results = _pool_map(create_user, [(u,) for u in plan['users']], workers)
+    collect('users', [u['name'] for u in plan['users']], results, 'user')
+    for result in results:
+        if not _failed(result):
+            current_users.update(result)
+    results = _pool_map(update_user, [(u,) for u in plan['user_updates']], workers)
+    collect('user_updates', [u['name'] for u in plan['user_updates']],
+            results, 'user')
+
+    def role_call(func):
+        def call(user, tenant, role):
+            if user not in current_users or tenant not in current_tenants \
+                    or role not in current_roles:
+                return {'Error': 'Unable to resolve user, role or tenant id'}
+            return __salt__[func](
+                    user_id=current_users[user]['id'],
+                    role_id=current_roles[role]['id'],
+                    tenant_id=current_tenants[tenant]['id'])
+        return call
+
+    results = _pool_map(role_call('keystone.user_role_add'), plan['grants'], workers)
+    collect('grants', plan['grants'], results, 'grant')
+    results = _pool_map(role_call('keystone.user_role_remove'), plan['revokes'], workers)
+    collect('revokes', plan['revokes'], results, 'revoke')
+
+    ret['changes'] = _describe(done)
+    if errors:
+        ret['result'] = False
+        ret['comment'] = 'Failed to sync keystone set {0}: {1}'.format(
+                name, '; '.join(errors))
+    else:
+        ret['comment'] = 'Keystone set {0} has been synced'.format(name)
+    return ret
@@ -25,11 +25,11 @@ def disabled(name, runas=None, env=None):
     name
         The name of the plugin to disable
     '''
+    ret = {'name': name, 'result': None, 'comment': '', 'changes': {}}
     if __opts__['test']:
         ret['comment'] = 'The plugin {0} would have been disabled'.format(name)
         return ret
 
-    ret = {'name': name, 'result': None, 'comment': '', 'changes': {}}
     plugins = __salt__['rabbitmq_plugins.list'](env=env, runas=runas)
     if name not in plugins:
         ret['result'] = True
@@ -57,11 +57,11 @@ def enabled(name, runas=None, env=None):
     name
         The name of the plugin to enable
     '''
+    ret = {'name': name, 'result': None, 'comment': '', 'changes': {}}
     if __opts__['test']:
         ret['comment'] = 'The plugin {0} would have been enabled'.format(name)
         return ret
 
-    ret = {'name': name, 'result': None, 'comment': '', 'changes': {}}
     plugins = __salt__['rabbitmq_plugins.list'](env=env, runas=runas)
     if name not in plugins:
         ret['result'] = True
@@ -81,3 +81,87 @@ def enabled(name, runas=None, env=None):
         ret['result'] = False
         ret['comment'] = 'Could not enable plugin.'
     return ret
+
+def plugins_enabled(name, plugins, prune=False, runas=None, env=None):
+    '''
+    Make sure that a whole set of plugins is enabled, with one listing and
+    at most one enable and one disable call.
+
+    name
+        An arbitrary name for this set
+    plugins
+        The names of the plugins to enable, as a list or a comma separated
+        string
+    prune
+        Also disable the explicitly enabled plugins which are not listed.
+        Listed plugins which are only enabled as a dependency of another
+        plugin are then enabled explicitly, so pruning cannot take them
+        down with the plugin they depend on. The plugins are listed again
+        afterwards, and the state fails if disabling an unlisted plugin
+        also disabled a listed one depending on it.
+    '''
+    ret = {'name': name, 'result': None, 'comment': '', 'changes': {}}
+    if isinstance(plugins, basestring):
+        plugins = plugins.replace(',', ' ').split()
+    current = __salt__['rabbitmq_plugins.list'](env=env, runas=runas)
+
+    missing = sorted(plugin for plugin in plugins if plugin not in current)
+    if missing:
+        ret['result'] = False
+        ret['comment'] = 'Plugins not available: {0}'.format(', '.join(missing))
+        return ret
+
+    enabled = ('E',) if prune else ('E', 'e')
+    to_enable = sorted(plugin for plugin in set(plugins)
+                       if current[plugin]['state'] not in enabled)
+    to_disable = []
+    if prune:
+        to_disable = sorted(plugin for plugin, info in current.items()
+                            if info['state'] == 'E' and plugin not in plugins)
+
+    if not to_enable and not to_disable:
+        ret['result'] = True
+        ret['comment'] = 'Plugins are already in the desired state.'
+        return ret
+
+    for plugin in to_enable:
+        ret['changes'][plugin] = 'Enabled'
+    for plugin in to_disable:
+        ret['changes'][plugin] = 'Disabled'
+    if __opts__['test']:
+        ret['comment'] = 'Plugins would have been changed.'
+        return ret
+
+    # enable first: a listed plugin which so far was only a dependency of a
+    # pruned one is then explicit and stays up while the other is disabled
+    errors = []
+    if to_enable and not __salt__['rabbitmq_plugins.enable'](
+            to_enable, env=env, runas=runas):
+        errors.append('Could not enable plugins.')
+    if to_disable and not __salt__['rabbitmq_plugins.disable'](
+            to_disable, env=env, runas=runas):
+        errors.append('Could not disable plugins.')
+
+    # disabling a plugin also disables the enabled plugins depending on it,
+    # which may include listed ones, so check the outcome instead of
+    # trusting the plan
+    after = __salt__['rabbitmq_plugins.list'](env=env, runas=runas,
+                                              refresh=True)
+    ret['changes'] = {}
+    for plugin in sorted(set(current) | set(after)):
+        before = current.get(plugin, {}).get('state', ' ')
+        now = after.get(plugin, {}).get('state', ' ')
+        if before != now:
+            ret['changes'][plugin] = 'Disabled' if now == ' ' else 'Enabled'
+    lost = sorted(plugin for plugin in set(plugins)
+                  if after.get(plugin, {}).get('state') not in enabled)
+    if lost:
+        errors.append('Plugins not enabled afterwards, probably disabled '
+                      'with a plugin they depend on: {0}.'.format(', '.join(lost)))
+    if errors:
+        ret['result'] = False
+        ret['comment'] = ' '.join(errors)
+    else:
+        ret['result'] = True
+        ret['comment'] = 'Plugins were successfully changed.'
+    return ret
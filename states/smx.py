@@ -31,14 +31,7 @@ def _get_latest_feature_version(feature):
     get the latest version available for this feature
     '''
     
-    feature_refreshurls()
-    ret = ''
-    for line in _parse_list(run('features:list')):
-        lst = line.split()
-        if feature == lst[2]:
-             ret = max(ret,lst[1])
-    
-    return ret
+    return __salt__['smx.latest_feature_version'](feature)
 
 def feature_repository_present(name):
     '''
@@ -5,7 +5,10 @@ try:
 except ImportError:
     import json
 
-import urllib2, subprocess, re, time
+import httplib, socket, subprocess, re, time, urlparse
+
+# errors the Zabbix frontend returns once an auth token has expired
+_RELOGIN_ERRORS = ('Session terminated', 'Not authorised', 'Not authorized')
 
 class ZabbixAPIException(Exception):
     pass
@@ -13,15 +16,24 @@ class ZabbixAPIException(Exception):
 class ZabbixAPI(object):
     __auth = ''
     __id = 0
+    __conn = None
+    cache = None
     _state = {}
     def __new__(cls, *args, **kw):
         if not cls._state.has_key(cls):
-            cls._state[cls] = super(ZabbixAPI, cls).__new__(cls, *args, **kw)
+            cls._state[cls] = super(ZabbixAPI, cls).__new__(cls)
         return cls._state[cls]
-    def __init__(self, url, user, password):
-        self.__url = url.rstrip('/') + '/api_jsonrpc.php'
+    def __init__(self, url, user, password, timeout=30, batch_size=100):
+        url = url.rstrip('/') + '/api_jsonrpc.php'
+        if (url, user) != (self.__dict__.get('_ZabbixAPI__url'), self.__dict__.get('_ZabbixAPI__user')):
+            # the shared instance is pointed somewhere else, drop session state
+            self.close()
+            self.__auth = ''
+        self.__url = url
         self.__user = user
         self.__password = password
+        self.__timeout = timeout
+        self.batch_size = batch_size
         self._zabbix_api_object_list = ('Action', 'Alert', 'APIInfo', 'Application', 'DCheck', 'DHost', 'DRule',
                 'DService', 'Event', 'Graph', 'Grahpitem', 'History', 'Host', 'Hostgroup', 'Image', 'Item',
                 'Maintenance', 'Map', 'Mediatype', 'Proxy', 'Screen', 'Script', 'Template', 'Trigger', 'User',
@@ -35,6 +47,7 @@ class ZabbixAPI(object):
     def login(self):
         user_info = {'user'     : self.__user,
                      'password' : self.__password}
+        self.__auth = ''
         obj = self.json_obj('user.login', user_info)
         content = self.postRequest(obj)
         try:
@@ -46,22 +59,127 @@ class ZabbixAPI(object):
         return self.__auth != ''
     def __checkAuth__(self):
         if not self.isLogin():
-            raise ZabbixAPIException("NOT logged in")
+            self.login()
+    def _request(self, method, params):
+        self.__id += 1
+        return { 'jsonrpc' : '2.0',
+                 'method'  : method,
+                 'params'  : params,
+                 'auth'    : self.__auth or None,
+                 'id'      : self.__id}
     def json_obj(self, method, params):
-        obj = { 'jsonrpc' : '2.0',
-                'method'  : method,
-                'params'  : params,
-                'auth'    : self.__auth,
-                'id'      : self.__id}
-        return json.dumps(obj)
+        return json.dumps(self._request(method, params))
+    def _connection(self):
+        if self.__conn is None:
+            parts = urlparse.urlsplit(self.__url)
+            if parts.scheme == 'https':
+                conn_class = httplib.HTTPSConnection
+            else:
+                conn_class = httplib.HTTPConnection
+            self.__conn = conn_class(parts.netloc, timeout=self.__timeout)
+            self.__path = parts.path
+        return self.__conn
+    def close(self):
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
     def postRequest(self, json_obj):
         headers = { 'Content-Type' : 'application/json-rpc',
-                    'User-Agent'   : 'python/zabbix_api'}
-        req = urllib2.Request(self.__url, json_obj, headers)
-        opener = urllib2.urlopen(req)
-        content = json.loads(opener.read())
-        self.__id += 1
-        return content
+                    'User-Agent'   : 'python/zabbix_api',
+                    'Connection'   : 'keep-alive'}
+        # a keep-alive connection may have been dropped by the server while
+        # idle, so retry once on a fresh one before giving up
+        for attempt in (1, 2):
+            conn = self._connection()
+            try:
+                conn.request('POST', self.__path, json_obj, headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                self.close()
+                if attempt == 2:
+                    raise ZabbixAPIException('Zabbix API request failed: %s' % e)
+                continue
+            if response.getheader('connection', '').lower() == 'close':
+                self.close()
+            if response.status != 200:
+                raise ZabbixAPIException('Zabbix API returned HTTP %s' % response.status)
+            return json.loads(body)
+    def _needsRelogin(self, content):
+        data = content.get('error', {}).get('data', '')
+        return any(msg in data for msg in _RELOGIN_ERRORS)
+    def call(self, method, params):
+        '''
+        Run one API method and return its result, logging in first if
+        needed and once more if the cached auth token has expired.
+        '''
+        self.__checkAuth__()
+        content = self.postRequest(self.json_obj(method, params))
+        if self._needsRelogin(content):
+            self.login()
+            content = self.postRequest(self.json_obj(method, params))
+        try:
+            return content['result']
+        except KeyError, e:
+            e = content['error']['data']
+            raise ZabbixAPIException(e)
+    def batch(self):
+        return ZabbixAPIBatch(self)
+    def warmCache(self, objects=None):
+        '''
+        Load every object of the given types into the cache with a single
+        batch request, indexed by the given filter fields. Defaults to all
+        hostgroups and templates.
+        '''
+        if self.cache is None:
+            return
+        if objects is None:
+            objects = {'Hostgroup': ('name',), 'Template': ('host', 'name')}
+        names = sorted(objects)
+        results = self.callBatch([('%s.get' % name, {'output': 'extend'}) for name in names])
+        for name, result in zip(names, results):
+            self.cache.load(name, result, objects[name])
+    def callBatch(self, calls):
+        '''
+        Run a list of (method, params) pairs as JSON-RPC 2.0 batch requests
+        of at most batch_size calls each and return their results in order.
+        '''
+        results = []
+        calls = list(calls)
+        for i in range(0, len(calls), self.batch_size):
+            results.extend(self._postBatch(calls[i:i + self.batch_size]))
+        return results
+    def _postBatch(self, calls):
+        if not calls:
+            return []
+        self.__checkAuth__()
+        for attempt in (1, 2):
+            requests = [self._request(method, params) for method, params in calls]
+            content = self.postRequest(json.dumps(requests))
+            if isinstance(content, dict):
+                # the whole batch was rejected, e.g. unparseable
+                if attempt == 1 and self._needsRelogin(content):
+                    self.login()
+                    continue
+                raise ZabbixAPIException(content.get('error', {}).get('data', content))
+            by_id = dict((response.get('id'), response) for response in content)
+            if attempt == 1 and any(self._needsRelogin(r) for r in content):
+                # an expired token fails every call of the batch alike
+                self.login()
+                continue
+            break
+        results = []
+        errors = []
+        for (method, params), request in zip(calls, requests):
+            response = by_id.get(request['id'], {})
+            if 'result' in response:
+                results.append(response['result'])
+            else:
+                results.append(None)
+                errors.append('%s: %s' % (method, response.get('error', {}).get('data', 'no response')))
+        if errors:
+            raise ZabbixAPIException('; '.join(errors))
+        return results
 
     '''
     /usr/local/zabbix/bin/zabbix_get is the default path to zabbix_get, it depends on the 'prefix' while install zabbix.
@@ -84,6 +202,90 @@ class ZabbixAPI(object):
         return [dict['host'] for dict in self.host.get({'hostids':hostids,'output':'extend'})]
 
 
+# API methods which do not modify anything and so keep the cache valid
+_READ_METHODS = ('get', 'exists', 'isreadable', 'iswritable')
+
+class ZabbixAPICache(object):
+    '''
+    Read-through cache for ZabbixAPIObjectFactory.find, keyed by object and
+    filter. Any write to an object type drops everything cached for it.
+    Fully loaded object types (see ZabbixAPI.warmCache) answer single field
+    filters from an index. saved counts the API calls that were avoided.
+    '''
+    def __init__(self):
+        self.entries = {}
+        self.indexes = {}
+        self.saved = 0
+    def get(self, object_name, params):
+        object_name = object_name.lower()
+        key = (object_name, json.dumps(params, sort_keys=True))
+        if key in self.entries:
+            self.saved += 1
+            return self.entries[key]
+        if len(params) == 1:
+            field, value = params.items()[0]
+            index = self.indexes.get((object_name, field))
+            if index is not None:
+                if not isinstance(value, list):
+                    value = [value]
+                result = []
+                for v in value:
+                    result.extend(index.get(str(v), []))
+                self.saved += 1
+                return result
+        return None
+    def set(self, object_name, params, result):
+        key = (object_name.lower(), json.dumps(params, sort_keys=True))
+        self.entries[key] = result
+    def load(self, object_name, objects, fields):
+        object_name = object_name.lower()
+        for field in fields:
+            index = {}
+            for obj in objects:
+                index.setdefault(str(obj.get(field)), []).append(obj)
+            self.indexes[(object_name, field)] = index
+    def invalidate(self, object_name):
+        object_name = object_name.lower()
+        for key in [k for k in self.entries if k[0] == object_name]:
+            del self.entries[key]
+        for key in [k for k in self.indexes if k[0] == object_name]:
+            del self.indexes[key]
+
+class ZabbixAPIBatch(object):
+    '''
+    Collects API calls and sends them as JSON-RPC 2.0 batches on execute().
+
+        batch = zapi.batch()
+        batch.Item.create({...})
+        batch.add('item.update', {...})
+        itemids, updated = batch.execute()
+    '''
+    def __init__(self, zapi):
+        self.__zapi = zapi
+        self.calls = []
+    def add(self, method, params):
+        object_name, method_name = method.split('.', 1)
+        if self.__zapi.cache is not None and method_name.lower() not in _READ_METHODS:
+            self.__zapi.cache.invalidate(object_name)
+        self.calls.append((method, params))
+        return len(self.calls) - 1
+    def __getattr__(self, object_name):
+        if object_name.startswith('_'):
+            raise AttributeError(object_name)
+        batch = self
+        class _BatchObject(object):
+            def __getattr__(self, method_name):
+                def method(params):
+                    return batch.add('%s.%s' % (object_name, method_name), params)
+                return method
+        return _BatchObject()
+    def __len__(self):
+        return len(self.calls)
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return self.__zapi.callBatch(calls)
+
+
 def checkAuth(func):
     def ret(self, *args):
         self.__checkAuth__()
@@ -93,23 +295,13 @@ def checkAuth(func):
 def postJson(method_name):
     def decorator(func):
         def wrapper(self, params):
-            try:
-                content = self.postRequest(self.json_obj(method_name, params))
-                return content['result']
-            except KeyError, e:
-                e = content['error']['data']
-                raise ZabbixAPIException(e)
+            return self.call(method_name, params)
         return wrapper
     return decorator
 
 def ZabbixAPIObjectMethod(func):
     def wrapper(self, method_name, params):
-        try:
-            content = self.postRequest(self.json_obj(method_name, params))
-            return content['result']
-        except KeyError, e:
-            e = content['error']['data']
-            raise ZabbixAPIException(e)
+        return self.call(method_name, params)
     return wrapper
 
 
@@ -123,14 +315,29 @@ class ZabbixAPIObjectFactory(object):
         return self.__zapi.postRequest(json_obj)
     def json_obj(self, method, param):
         return self.__zapi.json_obj(method, param)
+    def call(self, method, params):
+        return self.__zapi.call(method, params)
     def __getattr__(self, method_name):
         def method(params):
+            if method_name.lower() not in _READ_METHODS:
+                self._invalidate()
             return self.proxyMethod('%s.%s' % (self.__object_name,method_name), params)
         return method
+    def _invalidate(self):
+        if self.__zapi.cache is not None:
+            self.__zapi.cache.invalidate(self.__object_name)
     def find(self, params, attr_name=None, to_create=False):
         filtered_list = []
-        result = self.proxyMethod('%s.get' % self.__object_name, {'output':'extend','filter': params})
+        cache = self.__zapi.cache
+        result = None
+        if cache is not None:
+            result = cache.get(self.__object_name, params)
+        if result is None:
+            result = self.proxyMethod('%s.get' % self.__object_name, {'output':'extend','filter': params})
+            if cache is not None:
+                cache.set(self.__object_name, params, result)
         if to_create and len(result) == 0:
+            self._invalidate()
             result = self.proxyMethod('%s.create' % self.__object_name, params)
             return result.values()[0]
         if attr_name is not None:
@@ -142,7 +349,6 @@ class ZabbixAPIObjectFactory(object):
 
 
     @ZabbixAPIObjectMethod
-    @checkAuth
     def proxyMethod(self, method_name, params):
         pass
 
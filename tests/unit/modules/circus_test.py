@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+'''
+Test module for circus, run against a local fake of the circusd endpoint
+'''
+
+import json
+import threading
+
+from salttesting import skipIf, TestCase
+from salttesting.helpers import ensure_in_syspath
+from salttesting.mock import NO_MOCK, NO_MOCK_REASON, MagicMock, patch
+
+ensure_in_syspath('../../')
+
+from salt.modules import circus
+
+circus.__salt__ = {}
+circus.__opts__ = {}
+
+INFOS = {
+    'web': {'101': {'cpu': 0.1, 'mem': 1.5}, '102': {'cpu': 0.0, 'mem': 1.4}},
+    'worker': {'201': {'cpu': 3.0, 'mem': 6.2}},
+}
+
+
+def fake_circusd(sock, commands):
+    '''
+    Answer commands like circusd does until a quit command
+    '''
+    while True:
+        identity, body = sock.recv_multipart()
+        message = json.loads(body)
+        command = message['command']
+        props = message['properties']
+        commands.append(command)
+        answer = {'id': message['id'], 'status': 'ok', 'time': 0}
+        if command == 'list':
+            if 'name' in props:
+                answer['pids'] = sorted(INFOS[props['name']])
+            else:
+                answer['watchers'] = sorted(INFOS)
+        elif command == 'stats':
+            if 'name' in props:
+                answer['info'] = INFOS[props['name']]
+            else:
+                answer['infos'] = INFOS
+        elif command == 'status':
+            if 'name' in props:
+                answer['status'] = 'active'
+            else:
+                answer['statuses'] = dict((name, 'active') for name in INFOS)
+        elif command != 'quit':
+            answer = {'id': message['id'], 'status': 'error',
+                      'reason': 'unknown command'}
+        sock.send_multipart([identity, json.dumps(answer)])
+        if command == 'quit':
+            return
+
+
+@skipIf(NO_MOCK, NO_MOCK_REASON)
+@skipIf(not circus.HAS_ZMQ, 'pyzmq is not installed')
+class CircusTestCase(TestCase):
+    def setUp(self):
+        context = circus.zmq.Context.instance()
+        self.server = context.socket(circus.zmq.ROUTER)
+        self.server.setsockopt(circus.zmq.LINGER, 0)
+        port = self.server.bind_to_random_port('tcp://127.0.0.1')
+        self.endpoint = 'tcp://127.0.0.1:{0}'.format(port)
+        self.commands = []
+        self.thread = threading.Thread(target=fake_circusd,
+                                       args=(self.server, self.commands))
+        self.thread.daemon = True
+        self.thread.start()
+        self.option = MagicMock(side_effect=lambda key: {
+            'circus.endpoint': self.endpoint, 'circus.timeout': 2}.get(key))
+
+    def tearDown(self):
+        with patch.dict(circus.__salt__, {'config.option': self.option}):
+            circus.signal('quit')
+        self.thread.join(2)
+        for endpoint in list(circus._SOCKETS):
+            circus._drop(endpoint)
+        self.server.close()
+
+    def test_structured_answers_over_one_socket(self):
+        with patch.dict(circus.__salt__, {'config.option': self.option}):
+            self.assertEqual(circus.list(), ['web', 'worker'])
+            self.assertEqual(circus.list('web'), ['101', '102'])
+            self.assertEqual(circus.stats(), INFOS)
+            self.assertEqual(circus.stats('worker'), INFOS['worker'])
+            self.assertEqual(circus.status('web'), {'web': 'active'})
+            self.assertEqual(circus.status(), {'web': 'active', 'worker': 'active'})
+        self.assertEqual(list(circus._SOCKETS), [self.endpoint])
+        self.assertEqual(self.commands,
+                         ['list', 'list', 'stats', 'stats', 'status', 'status'])
+
+    def test_error_answer(self):
+        with patch.dict(circus.__salt__, {'config.option': self.option}):
+            self.assertIn('Error', circus.dstats())
+
+
+@skipIf(NO_MOCK, NO_MOCK_REASON)
+class CircusLoadTestCase(TestCase):
+    def test_virtual_needs_circusctl_or_endpoint(self):
+        with patch('salt.modules.circus.__detect_os', MagicMock(return_value=None)):
+            with patch.dict(circus.__opts__, {}, clear=True):
+                self.assertFalse(circus.__virtual__())
+            with patch.dict(circus.__opts__, {'circus.endpoint': 'tcp://127.0.0.1:5555'}):
+                self.assertEqual(circus.__virtual__(),
+                                 'circus' if circus.HAS_ZMQ else False)
+        with patch('salt.modules.circus.__detect_os',
+                   MagicMock(return_value='/usr/bin/circusctl')):
+            self.assertEqual(circus.__virtual__(), 'circus')
+
+    def test_version_without_circusctl(self):
+        with patch('salt.modules.circus.__detect_os', MagicMock(return_value=None)):
+            self.assertIn('Error', circus.version())
+
+
+if __name__ == '__main__':
+    from integration import run_tests
+
+    run_tests(CircusTestCase, CircusLoadTestCase, needs_daemon=False)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''
+Test module for riak, run against a local fake of riak's HTTP interface
+'''
+
+import json
+import socket
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from salttesting import skipIf, TestCase
+from salttesting.helpers import ensure_in_syspath
+from salttesting.mock import NO_MOCK, NO_MOCK_REASON, MagicMock, patch
+
+ensure_in_syspath('../../')
+
+from salt.modules import riak
+
+riak.__salt__ = {}
+riak.__context__ = {}
+
+STATS = {
+    'nodename': 'riak@127.0.0.1',
+    'ring_members': ['riak@127.0.0.1', 'riak@127.0.0.2'],
+    'ring_num_partitions': 64,
+    'node_gets': 12,
+    'memory_total': 31046480,
+}
+
+
+class FakeRiakHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        if self.path == '/ping':
+            body = 'OK'
+        elif self.path == '/stats':
+            body = json.dumps(STATS)
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@skipIf(NO_MOCK, NO_MOCK_REASON)
+class RiakTestCase(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeRiakHandler)
+        self.server.clients = set()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        riak._CONNECTIONS.clear()
+
+    def tearDown(self):
+        for conn in riak._CONNECTIONS.values():
+            conn.close()
+        riak._CONNECTIONS.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_is_up_and_status_share_connection(self):
+        option = MagicMock(return_value=self.url)
+        with patch.dict(riak.__salt__, {'config.option': option}):
+            self.assertTrue(riak.is_up())
+            self.assertEqual(riak.ping(), 'pong')
+            self.assertEqual(riak.status(), STATS)
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_is_up_false_when_unreachable(self):
+        # grab a free port and close it again so nothing listens there
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:{0}'.format(sock.getsockname()[1])
+        sock.close()
+        option = MagicMock(return_value=url)
+        with patch.dict(riak.__salt__, {'config.option': option}):
+            self.assertFalse(riak.is_up())
+            self.assertIn('Error', riak.status())
+
+
+TRANSFERS = '''\
+'riak@10.0.0.1' waiting to handoff 3 partitions
+'riak@10.0.0.2' waiting to handoff 1 partitions
+
+Active Transfers:
+
+transfer type: ownership_transfer
+vnode type: riak_kv_vnode
+partition: 1164634117248063262943561351070788031288321245184
+started: 2014-05-30 12:00:13 [1.23 min ago]
+last update: 2014-05-30 12:01:27 [1.20 s ago]
+total size: 1,048,576 bytes
+objects transferred: 12,345
+
+                         12,345 Objs       30.48 KB/s
+    'riak@10.0.0.1'  =======>  'riak@10.0.0.3'
+        |=====     |  50%
+'''
+
+
+class RiakAdminTestCase(TestCase):
+    def setUp(self):
+        riak.__context__.clear()
+
+    def test_transfers_with_active_handoff(self):
+        option = MagicMock(return_value=None)
+        run = MagicMock(return_value=TRANSFERS)
+        with patch.dict(riak.__salt__, {'config.option': option,
+                                        'cmd.run': run}):
+            ret = riak.transfers()
+        self.assertEqual(ret['pending'], 4)
+        transfer = ret['active'][0]
+        self.assertEqual(transfer['objects'], 12345)
+        self.assertEqual(transfer['percent'], 50.0)
+        self.assertEqual(transfer['source'], 'riak@10.0.0.1')
+        self.assertEqual(transfer['target'], 'riak@10.0.0.3')
+
+    def test_admin_cache_ttl_zero(self):
+        option = MagicMock(return_value=0)
+        run = MagicMock(return_value='')
+        with patch.dict(riak.__salt__, {'config.option': option,
+                                        'cmd.run': run}):
+            riak.transfers()
+            riak.transfers()
+        self.assertEqual(run.call_count, 2)
+
+
+if __name__ == '__main__':
+    from integration import run_tests
+
+    run_tests(RiakTestCase, RiakAdminTestCase, needs_daemon=False)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+'''
+Test module for the zabbix.sync plan, fed with objects formatted the way
+the Zabbix API returns them
+'''
+
+from salttesting import TestCase
+from salttesting.helpers import ensure_in_syspath
+
+ensure_in_syspath('../../')
+ensure_in_syspath('../../../states')
+
+from salt.modules import zabbix
+
+CURRENT = {
+    'applications': [{'applicationid': '11', 'name': 'CPU', 'templateid': '0'}],
+    'macros': [],
+    'items': [{'itemid': '21', 'key_': 'system.cpu.load', 'name': 'CPU load',
+               'type': '0', 'value_type': '0', 'data_type': '0',
+               'delta': '0', 'delay': '60', 'templateid': '0',
+               'applications': [{'applicationid': '11'}]}],
+    'triggers': [{'triggerid': '31', 'description': 'High load',
+                  'expression': '{tpl:system.cpu.load.last(0)}>5',
+                  'priority': '3', 'status': '0', 'templateid': '0'}],
+    'graphs': [{'graphid': '41', 'name': 'Load', 'width': '900',
+                'height': '200', 'graphtype': '0', 'ymax_type': '0',
+                'yaxismax': '100.0000', 'ymin_type': '0',
+                'yaxismin': '0.0000', 'templateid': '0',
+                'gitems': [{'itemid': '21', 'sortorder': '0'}]}],
+}
+
+ITEMS = [{'name': 'CPU load', 'key': 'system.cpu.load', 'application': 'CPU'}]
+TRIGGERS = [{'name': 'High load', 'expression': '{tpl:system.cpu.load.last(0)}>5',
+             'priority': 3}]
+GRAPHS = [{'name': 'Load', 'width': 900, 'height': 200, 'yaxismax': 100,
+           'keys': ['system.cpu.load']}]
+
+
+class ZabbixSyncTestCase(TestCase):
+    def plan(self, graphs):
+        return zabbix._sync_plan('1', CURRENT, ['CPU'], ITEMS, TRIGGERS,
+                                 graphs, None, False)
+
+    def test_api_float_strings_are_unchanged(self):
+        plan = self.plan(GRAPHS)
+        for kind in ('items', 'triggers', 'graphs'):
+            self.assertEqual(plan[kind]['create'], [])
+            self.assertEqual(plan[kind]['update'], [])
+
+    def test_numeric_change_is_updated(self):
+        plan = self.plan([dict(GRAPHS[0], yaxismax=50)])
+        self.assertEqual([fields['graphid'] for fields, _ in plan['graphs']['update']],
+                         ['41'])
+
+    def test_non_ascii_values(self):
+        current = dict(CURRENT, triggers=[dict(CURRENT['triggers'][0],
+                                               description=u'Charge \xe9lev\xe9e')],
+                       macros=[{'macro': '{$OWNER}', 'value': u'Ren\xe9'}])
+        triggers = [dict(TRIGGERS[0], name='Charge \xc3\xa9lev\xc3\xa9e')]
+        plan = zabbix._sync_plan('1', current, ['CPU'], ITEMS, triggers,
+                                 GRAPHS, {'{$OWNER}': u'Ren\xe9'}, False)
+        self.assertEqual(plan['triggers']['create'], [])
+        self.assertEqual(plan['triggers']['update'], [])
+        self.assertEqual(plan['macros'], None)
+
+
+class ZabbixCacheTestCase(TestCase):
+    def test_saved_calls_are_returned(self):
+        zabbix.__context__ = {}
+        zabbix.__opts__ = {}
+        cache = zabbix._cache()
+        cache.set('host', {'name': 'web1'}, [{'hostid': '1'}])
+        cache.get('host', {'name': 'web1'})
+        ret = zabbix._finish({'name': 'web1', 'changes': {}, 'result': True,
+                              'comment': 'Host web1 exists'})
+        self.assertEqual(ret['api_calls_saved'], 1)
+        self.assertEqual(ret['changes'], {})
+
+
+if __name__ == '__main__':
+    from integration import run_tests
+
+    run_tests(ZabbixSyncTestCase, ZabbixCacheTestCase, needs_daemon=False)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+'''
+Test module for the zapi Zabbix API client, run against a local fake
+JSON-RPC endpoint
+'''
+
+import json
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from salttesting import TestCase
+from salttesting.helpers import ensure_in_syspath
+
+ensure_in_syspath('../../')
+
+from salt.states import zapi
+
+
+class FakeZabbixHandler(BaseHTTPRequestHandler):
+    '''
+    Minimal api_jsonrpc.php: user.login hands out a token, every other
+    method echoes its params back unless the token was expired.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        server.clients.add(self.client_address)
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if isinstance(body, list):
+            server.posts.append(len(body))
+            content = [self._dispatch(request) for request in body]
+        else:
+            server.posts.append(1)
+            content = self._dispatch(body)
+        data = json.dumps(content)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, request):
+        server = self.server
+        server.methods.append(request['method'])
+        if request['method'] == 'user.login':
+            server.token += 1
+            return {'jsonrpc': '2.0', 'result': str(server.token), 'id': request['id']}
+        if request['auth'] != str(server.token):
+            return {'jsonrpc': '2.0', 'id': request['id'],
+                    'error': {'code': -32602, 'message': 'Invalid params.',
+                              'data': 'Session terminated, re-login, please.'}}
+        return {'jsonrpc': '2.0', 'result': request['params'], 'id': request['id']}
+
+
+class ZabbixAPITestCase(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeZabbixHandler)
+        self.server.clients = set()
+        self.server.posts = []
+        self.server.methods = []
+        self.server.token = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        zapi.ZabbixAPI._state.clear()
+        self.api = zapi.ZabbixAPI(url='http://127.0.0.1:{0}/zabbix'.format(self.server.server_port),
+                                  user='admin', password='zabbix', batch_size=10)
+
+    def tearDown(self):
+        self.api.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_login_is_lazy_and_connection_reused(self):
+        self.assertFalse(self.api.isLogin())
+        self.assertEqual(self.api.call('host.get', {'a': 1}), {'a': 1})
+        self.assertEqual(self.api.call('host.get', {'a': 2}), {'a': 2})
+        self.assertEqual(self.server.methods, ['user.login', 'host.get', 'host.get'])
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_relogin_on_expired_session(self):
+        self.api.call('host.get', {})
+        self.server.token += 1
+        self.assertEqual(self.api.call('host.get', {'b': 1}), {'b': 1})
+        self.assertEqual(self.server.methods.count('user.login'), 2)
+
+    def test_batch_is_chunked_and_ordered(self):
+        batch = self.api.batch()
+        for i in range(25):
+            batch.Item.create({'name': 'item{0}'.format(i)})
+        results = batch.execute()
+        self.assertEqual([r['name'] for r in results],
+                         ['item{0}'.format(i) for i in range(25)])
+        # one login plus three batches of at most ten calls
+        self.assertEqual(self.server.posts, [1, 10, 10, 5])
+        self.assertEqual(len(batch), 0)
+
+    def test_helper_methods_stay_on_client(self):
+        obj = self.api.createObject(zapi.ZabbixAPIObjectFactory, 'host')
+        self.assertIsInstance(obj, zapi.ZabbixAPIObjectFactory)
+        self.assertTrue(callable(self.api.getHostByHostid))
+        self.assertTrue(callable(zapi.ZabbixAPI.zabbixGet))
+
+
+if __name__ == '__main__':
+    from integration import run_tests
+
+    run_tests(ZabbixAPITestCase, needs_daemon=False)